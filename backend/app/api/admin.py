@@ -1,10 +1,11 @@
 from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import ORJSONResponse
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from pydantic import BaseModel
 from typing import List, Optional
 from ..core.database import get_database
 
-router = APIRouter(prefix="/api/admin", tags=["Admin"])
+router = APIRouter(prefix="/api/admin", tags=["Admin"], default_response_class=ORJSONResponse)
 
 class NotificationUpdate(BaseModel):
     message: str
@@ -54,7 +55,7 @@ async def update_slider_images(
     """Update slider images"""
     await db.admin_settings.update_one(
         {"type": "slider"},
-        {"$set": {"images": [img.dict() for img in update.images], "type": "slider"}},
+        {"$set": {"images": update.model_dump()["images"], "type": "slider"}},
         upsert=True
     )
     return {"success": True, "message": "Slider images updated"}
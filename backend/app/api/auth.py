@@ -5,56 +5,84 @@ Handles user registration, login (manual & face-based), token management.
 """
 
 from fastapi import APIRouter, Depends, HTTPException, status, Header
+from fastapi.responses import ORJSONResponse
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
+from collections import OrderedDict
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import DuplicateKeyError
+import asyncio
 import secrets
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
 from ..core.database import get_database
+from ..core.rate_limit import check_and_record
+from ..core.config import settings
 from ..core.security import (
-    hash_password, verify_password, create_access_token, create_refresh_token,
-    decode_token, generate_device_fingerprint, encrypt_embedding
+    hash_password_async, verify_password_async, password_needs_rehash, create_access_token,
+    create_refresh_token, decode_token, invalidate_token, generate_device_fingerprint, encrypt_embedding_async,
+    build_token_snapshot
 )
 from ..core.face_verification import (
-    validate_embedding_quality, find_user_by_face
+    validate_embedding_quality, find_user_by_face, embedding_array
 )
+from ..core.face_index import face_index
 from ..api.models import (
     UserRegister, UserLogin, FaceAutoLogin, TokenResponse, RefreshTokenRequest,
     AutoLoginResponse
 )
 
-router = APIRouter(prefix="/api/auth", tags=["Authentication"])
+# Auto-login only echoes these back for the login form
+AUTO_LOGIN_PROJECTION = {"username": 1, "name": 1}
 
-# Rate limiting storage (in-memory for demo, use Redis in production)
-login_attempts = {}
+router = APIRouter(prefix="/api/auth", tags=["Authentication"], default_response_class=ORJSONResponse)
+
+# In-process rate limiting: the only limiter without Redis, and a fast
+# path in front of Redis (a local count never exceeds the shared one)
+LOGIN_ATTEMPTS_MAX_KEYS = 10_000
+login_attempts: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+
+
+def _record_local_attempt(key: str) -> bool:
+    """Record a login attempt in the in-process LRU, return False if over limit"""
+    now = time.monotonic()
+    entry = login_attempts.get(key)
+    
+    if entry is None or now - entry[1] > settings.LOGIN_RATE_WINDOW:
+        # First attempt or window expired
+        login_attempts[key] = (1, now)
+        allowed = True
+    elif entry[0] >= settings.LOGIN_RATE_LIMIT:
+        allowed = False
+    else:
+        login_attempts[key] = (entry[0] + 1, entry[1])
+        allowed = True
+    
+    login_attempts.move_to_end(key)
+    if len(login_attempts) > LOGIN_ATTEMPTS_MAX_KEYS:
+        login_attempts.popitem(last=False)
+    
+    return allowed
 
 
 async def check_rate_limit(username: str) -> bool:
     """Check if user exceeded login rate limit"""
-    from ..core.config import settings
-    
-    current_time = datetime.utcnow()
     key = f"login:{username}"
     
-    if key in login_attempts:
-        attempts, first_attempt = login_attempts[key]
-        
-        # Reset if window expired
-        if (current_time - first_attempt).total_seconds() > settings.LOGIN_RATE_WINDOW:
-            login_attempts[key] = (1, current_time)
-            return True
-        
-        # Check if exceeded limit
-        if attempts >= settings.LOGIN_RATE_LIMIT:
-            return False
-        
-        # Increment attempts
-        login_attempts[key] = (attempts + 1, first_attempt)
-    else:
-        login_attempts[key] = (1, current_time)
+    if not _record_local_attempt(key):
+        return False
+    
+    # Rolling window shared by all workers when Redis is configured
+    shared = await check_and_record(
+        username, "login", settings.LOGIN_RATE_LIMIT, settings.LOGIN_RATE_WINDOW
+    )
+    if shared is not None:
+        return shared[0]
     
     return True
 
@@ -85,9 +113,11 @@ async def register(
             )
         
         # Validate and encrypt face embedding if provided
+        face_embedding = None
         face_embedding_encrypted = None
         if user_data.face_embedding:
-            is_valid, error_msg = validate_embedding_quality(user_data.face_embedding)
+            face_embedding = embedding_array(user_data.face_embedding)
+            is_valid, error_msg = validate_embedding_quality(face_embedding)
             if not is_valid:
                 raise HTTPException(
                     status_code=status.HTTP_400_BAD_REQUEST,
@@ -95,13 +125,13 @@ async def register(
                 )
             
             # Encrypt embedding
-            face_embedding_encrypted = encrypt_embedding(user_data.face_embedding)
+            face_embedding_encrypted = await encrypt_embedding_async(face_embedding)
         
         # Hash password
         logger.info(f"Hashing password for user: {user_data.username}")
         logger.info(f"Password length: {len(user_data.password)} chars, {len(user_data.password.encode('utf-8'))} bytes")
         logger.info(f"Password first 20 chars: {user_data.password[:20]}")
-        hashed_password = hash_password(user_data.password)
+        hashed_password = await hash_password_async(user_data.password)
         logger.info("Password hashed successfully")
         
         # Create user document
@@ -119,9 +149,20 @@ async def register(
             "balance": 10000.00  # Initial balance for demo
         }
         
-        result = await db.users.insert_one(user_doc)
+        try:
+            result = await db.users.insert_one(user_doc)
+        except DuplicateKeyError as e:
+            # A concurrent registration won the race past the checks above
+            key_pattern = (e.details or {}).get("keyPattern", {})
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Email already registered" if "email" in key_pattern else "Username already exists"
+            )
         user_id = str(result.inserted_id)
         
+        if face_embedding is not None:
+            face_index.add(user_id, face_embedding)
+        
         # Create a session for freshly registered users so monitoring APIs work
         session_doc = {
             "user_id": user_id,
@@ -129,7 +170,7 @@ async def register(
             "device_fingerprint": f"register:{secrets.token_hex(16)}",
             "ip_address": None,
             "browser_signature": "registration_flow",
-            "created_at": datetime.utcnow().isoformat(),
+            "created_at": datetime.utcnow(),
             "threat_score": 0,
             "is_locked": False,
             "requires_facial_captcha": False
@@ -139,7 +180,9 @@ async def register(
 
         # Create tokens
         token_data = {"sub": user_id, "username": user_data.username, "session_id": session_id}
-        access_token = create_access_token(token_data)
+        access_token = create_access_token(
+            token_data, snapshot=build_token_snapshot(user_doc, session_doc)
+        )
         refresh_token = create_refresh_token(token_data)
         
         return TokenResponse(
@@ -206,12 +249,19 @@ async def login(
         )
     
     # Verify password
-    if not verify_password(credentials.password, user["password_hash"]):
+    if not await verify_password_async(credentials.password, user["password_hash"]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid credentials"
         )
     
+    # Migrate legacy bcrypt hashes (or outdated Argon2 parameters)
+    if password_needs_rehash(user["password_hash"]):
+        await db.users.update_one(
+            {"_id": user["_id"]},
+            {"$set": {"password_hash": await hash_password_async(credentials.password)}}
+        )
+    
     # Create session
     user_id = str(user["_id"])
     device_fp = credentials.device_fingerprint or generate_device_fingerprint(
@@ -225,7 +275,7 @@ async def login(
         "device_fingerprint": device_fp,
         "ip_address": credentials.ip_address,
         "browser_signature": credentials.user_agent,
-        "created_at": datetime.utcnow().isoformat(),
+        "created_at": datetime.utcnow(),
         "threat_score": 0,
         "is_locked": False,
         "requires_facial_captcha": False
@@ -240,7 +290,9 @@ async def login(
         "username": user["username"],
         "session_id": session_id
     }
-    access_token = create_access_token(token_data)
+    access_token = create_access_token(
+        token_data, snapshot=build_token_snapshot(user, session_doc)
+    )
     refresh_token = create_refresh_token(token_data)
     
     return TokenResponse(
@@ -260,7 +312,8 @@ async def auto_login(
     Finds user by face match, then requires password + facial CAPTCHA
     """
     # Validate embedding
-    is_valid, error_msg = validate_embedding_quality(face_data.face_embedding)
+    face_embedding = embedding_array(face_data.face_embedding)
+    is_valid, error_msg = validate_embedding_quality(face_embedding)
     if not is_valid:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -268,7 +321,7 @@ async def auto_login(
         )
     
     # Search for matching user
-    user = await find_user_by_face(db, face_data.face_embedding)
+    user = await find_user_by_face(db, face_embedding, projection=AUTO_LOGIN_PROJECTION)
     
     if not user:
         raise HTTPException(
@@ -303,13 +356,34 @@ async def refresh_token(
     username = payload.get("username")
     session_id = payload.get("session_id")
     
+    # Refresh the state snapshot carried by the access token
+    snapshot = None
+    try:
+        # Convert both ids before creating any query coroutine, so a malformed
+        # id can't leave one un-awaited
+        user_oid = ObjectId(user_id)
+        session_oid = ObjectId(session_id) if session_id else None
+    except (InvalidId, TypeError):
+        user_oid = None
+
+    if user_oid is not None:
+        if session_oid is not None:
+            user, session = await asyncio.gather(
+                db.users.find_one({"_id": user_oid}),
+                db.sessions.find_one({"_id": session_oid})
+            )
+        else:
+            user, session = await db.users.find_one({"_id": user_oid}), None
+        if user:
+            snapshot = build_token_snapshot(user, session)
+    
     # Create new access token
     token_data = {
         "sub": user_id,
         "username": username,
         "session_id": session_id
     }
-    access_token = create_access_token(token_data)
+    access_token = create_access_token(token_data, snapshot=snapshot)
     
     return {"access_token": access_token, "token_type": "bearer"}
 
@@ -335,6 +409,7 @@ async def logout(
             detail="Invalid token"
         )
     
+    invalidate_token(token)
     session_id = payload.get("session_id")
     
     # Delete session
@@ -4,64 +4,33 @@ Banking API Endpoints
 Handles account operations with risk-based authorization.
 """
 
-from fastapi import APIRouter, Depends, HTTPException, status, Header
+from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks, Response
+from fastapi.responses import ORJSONResponse
 from motor.motor_asyncio import AsyncIOMotorDatabase
-from typing import Optional, List
+from typing import List
+from pydantic import TypeAdapter
 from datetime import datetime
+from pymongo import ReturnDocument
 import secrets
 
 from ..core.database import get_database
-from ..core.security import decode_token
 from ..core.config import settings
+from ..api.deps import get_current_account, get_current_user_snapshot
 from ..api.models import (
     AccountBalanceResponse, Transaction, PaymentRequest, PaymentResponse
 )
 
-router = APIRouter(prefix="/api/banking", tags=["Banking"])
+router = APIRouter(prefix="/api/banking", tags=["Banking"], default_response_class=ORJSONResponse)
 
+_TX_LIST_ADAPTER = TypeAdapter(List[Transaction])
+TRANSACTION_PROJECTION = {
+    "type": 1, "amount": 1, "description": 1, "timestamp": 1, "balance_after": 1
+}
 
-async def get_current_user(
-    authorization: Optional[str] = Header(None),
-    db: AsyncIOMotorDatabase = Depends(get_database)
-):
-    """Get current authenticated user and session"""
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Missing authentication"
-        )
-    
-    token = authorization.split(" ")[1]
-    payload = decode_token(token)
-    
-    if not payload:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid token"
-        )
-    
-    user_id = payload.get("sub")
-    session_id = payload.get("session_id")
-    
-    # Convert string IDs to ObjectId for MongoDB query
-    from bson import ObjectId
-    try:
-        user_object_id = ObjectId(user_id)
-        session_object_id = ObjectId(session_id) if session_id else None
-    except:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid ID"
-        )
-    
-    user = await db.users.find_one({"_id": user_object_id})
-    session = await db.sessions.find_one({"_id": session_object_id}) if session_object_id else None
-    
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found"
-        )
+
+def _reject_locked_session(current: dict) -> dict:
+    """Reject requests whose session is locked"""
+    session = current["session"]
     
     # Check if session is locked
     if session and session.get("is_locked"):
@@ -70,12 +39,26 @@ async def get_current_user(
             detail="Session locked. Complete facial CAPTCHA to continue."
         )
     
-    return {"user": user, "session": session}
+    return current
+
+
+async def get_unlocked_user(
+    current: dict = Depends(get_current_account)
+):
+    """Get current authenticated user, rejecting locked sessions"""
+    return _reject_locked_session(current)
+
+
+async def get_unlocked_user_snapshot(
+    current: dict = Depends(get_current_user_snapshot)
+):
+    """Like get_unlocked_user, but may be served from the token snapshot"""
+    return _reject_locked_session(current)
 
 
 @router.get("/balance", response_model=AccountBalanceResponse)
 async def get_balance(
-    current: dict = Depends(get_current_user)
+    current: dict = Depends(get_unlocked_user_snapshot)
 ):
     """Get account balance"""
     user = current["user"]
@@ -89,7 +72,7 @@ async def get_balance(
 
 @router.get("/transactions", response_model=List[Transaction])
 async def get_transactions(
-    current: dict = Depends(get_current_user),
+    current: dict = Depends(get_unlocked_user_snapshot),
     db: AsyncIOMotorDatabase = Depends(get_database),
     limit: int = 20
 ):
@@ -99,28 +82,28 @@ async def get_transactions(
     
     # Fetch transactions
     transactions_cursor = db.transactions.find(
-        {"user_id": user_id}
+        {"user_id": user_id},
+        projection=TRANSACTION_PROJECTION
     ).sort("timestamp", -1).limit(limit)
     
     transactions = await transactions_cursor.to_list(length=limit)
-    
-    return [
-        Transaction(
-            transaction_id=str(tx["_id"]),
-            type=tx.get("type", "DEBIT"),
-            amount=tx.get("amount", 0.0),
-            description=tx.get("description", ""),
-            timestamp=tx.get("timestamp"),
-            balance_after=tx.get("balance_after", 0.0)
-        )
-        for tx in transactions
-    ]
+    for tx in transactions:
+        tx["transaction_id"] = str(tx.pop("_id"))
+    
+    # Validate and serialize the whole list in pydantic-core; returning a
+    # Response skips FastAPI's second validation pass over response_model
+    validated = _TX_LIST_ADAPTER.validate_python(transactions)
+    return Response(
+        content=_TX_LIST_ADAPTER.dump_json(validated),
+        media_type="application/json"
+    )
 
 
 @router.post("/payment", response_model=PaymentResponse)
 async def create_payment(
     payment: PaymentRequest,
-    current: dict = Depends(get_current_user),
+    background: BackgroundTasks,
+    current: dict = Depends(get_unlocked_user),
     db: AsyncIOMotorDatabase = Depends(get_database)
 ):
     """
@@ -149,22 +132,40 @@ async def create_payment(
             detail="Transaction blocked due to security concerns"
         )
     
-    # Check sufficient balance
-    current_balance = user.get("balance", 0.0)
-    if current_balance < payment.amount:
+    # Check account lock and sufficient balance
+    if user.get("is_locked"):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Account is locked due to security concerns"
+        )
+    
+    # Atomically debit balance; the filter guards against concurrent
+    # payments overdrawing the account
+    updated = await db.users.find_one_and_update(
+        {
+            "_id": user["_id"],
+            "balance": {"$gte": payment.amount},
+            "is_locked": {"$ne": True}
+        },
+        {"$inc": {"balance": -payment.amount}},
+        projection={"balance": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    
+    if updated is None:
+        # Either guard can fail; a lock set since the check above wins
+        current_state = await db.users.find_one({"_id": user["_id"]}, projection={"is_locked": 1})
+        if current_state and current_state.get("is_locked"):
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Account is locked due to security concerns"
+            )
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Insufficient balance"
         )
     
-    # Process payment
-    new_balance = current_balance - payment.amount
-    
-    # Update user balance
-    await db.users.update_one(
-        {"_id": user["_id"]},
-        {"$set": {"balance": new_balance}}
-    )
+    new_balance = updated["balance"]
     
     # Create transaction record
     transaction_id = f"TXN{secrets.token_hex(8).upper()}"
@@ -181,7 +182,8 @@ async def create_payment(
         "threat_score_at_time": threat_score
     }
     
-    await db.transactions.insert_one(transaction_doc)
+    # Record the transaction after the response is sent
+    background.add_task(db.transactions.insert_one, transaction_doc)
     
     return PaymentResponse(
         success=True,
@@ -193,7 +195,7 @@ async def create_payment(
 
 @router.post("/account/lock")
 async def lock_account(
-    current: dict = Depends(get_current_user),
+    current: dict = Depends(get_unlocked_user),
     db: AsyncIOMotorDatabase = Depends(get_database)
 ):
     """Lock account (user-initiated)"""
@@ -209,7 +211,7 @@ async def lock_account(
 
 @router.post("/account/unlock")
 async def unlock_account(
-    current: dict = Depends(get_current_user),
+    current: dict = Depends(get_unlocked_user),
     db: AsyncIOMotorDatabase = Depends(get_database)
 ):
     """Unlock account (requires facial CAPTCHA in production)"""
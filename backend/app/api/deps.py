@@ -0,0 +1,199 @@
+"""
+Shared API Dependencies
+
+Authentication dependencies used across routers. Sharing a single callable
+lets FastAPI's per-request dependency cache resolve it only once.
+"""
+
+from fastapi import Depends, HTTPException, status, Header
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from typing import Optional
+from functools import lru_cache
+from bson import ObjectId
+import asyncio
+import logging
+import re
+import time
+
+from ..core.database import get_database
+from ..core.security import decode_token
+from ..core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# User fields needed by endpoints that never touch the face embedding
+ACCOUNT_PROJECTION = {"username": 1, "account_no": 1, "balance": 1, "is_locked": 1}
+
+# User fields needed by the face/CAPTCHA/monitoring endpoints
+FACE_USER_PROJECTION = {"username": 1, "face_embedding_encrypted": 1}
+
+# Session fields read by any authenticated endpoint
+SESSION_PROJECTION = {
+    "threat_score": 1,
+    "threat_breakdown": 1,
+    "threat_triggers": 1,
+    "is_locked": 1,
+    "requires_facial_captcha": 1,
+    "device_fingerprint": 1,
+    "ip_address": 1,
+    "browser_signature": 1,
+    "created_at": 1,
+    "last_heartbeat": 1,
+    "no_face_streak": 1,
+    "multi_face_streak": 1,
+    "signals_fingerprint": 1
+}
+
+
+def _decode_bearer(authorization: Optional[str]) -> dict:
+    """Extract and decode the bearer token from the Authorization header"""
+    if not authorization or not authorization.startswith("Bearer "):
+        logger.debug("[Auth] Missing or malformed authorization header")
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Missing authentication"
+        )
+
+    token = authorization.split(" ")[1]
+    payload = decode_token(token)
+
+    if not payload:
+        logger.debug("[Auth] Token decode failed")
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid token"
+        )
+
+    return payload
+
+
+# ObjectId hex form; validated up front instead of relying on exceptions
+_OID_RE = re.compile(r"[0-9a-fA-F]{24}")
+
+
+@lru_cache(maxsize=65_536)
+def _to_oid(hex_str: str) -> ObjectId:
+    """Build an ObjectId once per distinct (already validated) hex string"""
+    return ObjectId(hex_str)
+
+
+def _is_oid(value) -> bool:
+    """Check that a value is a 24-character hex ObjectId string"""
+    return isinstance(value, str) and _OID_RE.fullmatch(value) is not None
+
+
+def _object_ids(payload: dict):
+    """Convert the user and session IDs of a token payload to ObjectIds"""
+    user_id = payload.get("sub")
+    session_id = payload.get("session_id")
+    
+    if not _is_oid(user_id) or (session_id and not _is_oid(session_id)):
+        logger.debug("[Auth] Invalid ObjectId in token payload")
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid ID"
+        )
+    
+    return _to_oid(user_id), _to_oid(session_id) if session_id else None
+
+
+async def _load_current(
+    db: AsyncIOMotorDatabase,
+    payload: dict,
+    user_projection: Optional[dict] = None
+) -> dict:
+    """Fetch the user and session documents referenced by a token payload"""
+    user_object_id, session_object_id = _object_ids(payload)
+
+    # User and session lookups are independent, run them concurrently
+    user_query = db.users.find_one({"_id": user_object_id}, projection=user_projection)
+    if session_object_id:
+        user, session = await asyncio.gather(
+            user_query,
+            db.sessions.find_one({"_id": session_object_id}, projection=SESSION_PROJECTION)
+        )
+    else:
+        user, session = await user_query, None
+
+    if not user:
+        logger.debug("[Auth] User not found for ID: %s", user_object_id)
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
+
+    return {"user": user, "session": session, "db": db}
+
+
+def _current_from_snapshot(payload: dict, snapshot: dict) -> dict:
+    """Rebuild partial user/session documents from a token state snapshot"""
+    user_object_id, session_object_id = _object_ids(payload)
+
+    user = {
+        "_id": user_object_id,
+        "username": payload.get("username"),
+        "account_no": snapshot.get("acct", ""),
+        "balance": snapshot.get("bal", 0.0)
+    }
+    session = None
+    if session_object_id:
+        session = {
+            "_id": session_object_id,
+            "threat_score": snapshot.get("ts", 0),
+            "is_locked": snapshot.get("lk", False),
+            "requires_facial_captcha": snapshot.get("cap", False)
+        }
+
+    return {"user": user, "session": session}
+
+
+async def get_current_user(
+    authorization: Optional[str] = Header(None),
+    db: AsyncIOMotorDatabase = Depends(get_database)
+) -> dict:
+    """Get current authenticated user and session (session may be None)"""
+    payload = _decode_bearer(authorization)
+    return await _load_current(db, payload, user_projection=FACE_USER_PROJECTION)
+
+
+async def get_current_account(
+    authorization: Optional[str] = Header(None),
+    db: AsyncIOMotorDatabase = Depends(get_database)
+) -> dict:
+    """Get current user (account fields only, no face embedding) and session"""
+    payload = _decode_bearer(authorization)
+    return await _load_current(db, payload, user_projection=ACCOUNT_PROJECTION)
+
+
+async def get_current_user_snapshot(
+    authorization: Optional[str] = Header(None),
+    db: AsyncIOMotorDatabase = Depends(get_database)
+) -> dict:
+    """
+    Get current user and session, trusting a fresh token snapshot if present
+
+    Only for read-only hot paths that need the snapshot fields (balance,
+    account number, threat score, lock and CAPTCHA flags). Falls back to the
+    database once the snapshot is older than TOKEN_SNAPSHOT_TTL_SECONDS.
+    """
+    payload = _decode_bearer(authorization)
+
+    snapshot = payload.get("snap")
+    issued_at = payload.get("iat", 0)
+    if snapshot and time.time() - issued_at < settings.TOKEN_SNAPSHOT_TTL_SECONDS:
+        return {**_current_from_snapshot(payload, snapshot), "db": db}
+
+    return await _load_current(db, payload, user_projection=ACCOUNT_PROJECTION)
+
+
+async def get_current_user_with_session(
+    current: dict = Depends(get_current_user)
+) -> dict:
+    """Get current authenticated user, requiring an active session"""
+    if not current["session"]:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="No active session found"
+        )
+
+    return current
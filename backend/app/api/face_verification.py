@@ -5,17 +5,26 @@ Separate endpoint for continuous face verification.
 Compares live face embeddings against stored user embeddings.
 """
 
-from fastapi import APIRouter, Depends, HTTPException, status, Header
+from fastapi import APIRouter, Depends, BackgroundTasks
+from fastapi.responses import ORJSONResponse
 from motor.motor_asyncio import AsyncIOMotorDatabase
-from typing import List, Optional
+from typing import List
 from pydantic import BaseModel
+from pymongo import ReturnDocument
+import numpy as np
+import math
 
 from ..core.database import get_database
-from ..core.security import decode_token
-from ..core.face_verification import calculate_face_distance
+from ..api.deps import get_current_user_with_session
+from ..core.face_verification import get_cached_embedding_async, FACE_DISTANCE_THRESHOLD_SQ
+from ..core.face_batcher import face_distance_batcher
+from ..core.threat_engine import ThreatEngine
 from ..sockets.websocket_manager import websocket_manager
 
-router = APIRouter(prefix="/api/face-verification", tags=["Face Verification"])
+# Same label the threat engine uses, so it maps to a known wire trigger id
+FACE_MISMATCH_TRIGGER = "Live face does not match database"
+
+router = APIRouter(prefix="/api/face-verification", tags=["Face Verification"], default_response_class=ORJSONResponse)
 
 
 class FaceVerificationRequest(BaseModel):
@@ -31,61 +40,52 @@ class FaceVerificationResponse(BaseModel):
     message: str
 
 
-async def get_current_user(
-    authorization: Optional[str] = Header(None),
-    db: AsyncIOMotorDatabase = Depends(get_database)
-) -> dict:
-    """Get current user from JWT token"""
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Missing or invalid authorization header"
-        )
-    
-    token = authorization.split(" ")[1]
-    payload = decode_token(token)
-    
-    if not payload:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid or expired token"
-        )
-    
-    user_id = payload.get("sub")
-    session_id = payload.get("session_id")
-    
-    from bson import ObjectId
-    try:
-        user_object_id = ObjectId(user_id)
-        session_object_id = ObjectId(session_id) if session_id else None
-    except Exception:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid user or session ID"
-        )
-
-    user = await db.users.find_one({"_id": user_object_id})
-    session = await db.sessions.find_one({"_id": session_object_id}) if session_object_id else None
+async def record_face_mismatch(
+    db: AsyncIOMotorDatabase,
+    session_id,
+    user_id: str,
+    threat_increase: int
+):
+    """Atomically raise the session threat score and broadcast the new value"""
+    # Pipeline update reads the current score server-side, so concurrent
+    # /check calls can't overwrite each other's increments
+    updated = await db.sessions.find_one_and_update(
+        {"_id": session_id},
+        [
+            {
+                "$set": {
+                    "threat_score": {
+                        "$min": [100, {"$add": [{"$ifNull": ["$threat_score", 0]}, threat_increase]}]
+                    },
+                    "threat_triggers": {
+                        "$concatArrays": [{"$ifNull": ["$threat_triggers", []]}, [FACE_MISMATCH_TRIGGER]]
+                    }
+                }
+            },
+            # Stored score no longer matches the last heartbeat's inputs
+            {"$unset": "signals_fingerprint"}
+        ],
+        projection={"threat_score": 1},
+        return_document=ReturnDocument.AFTER
+    )
     
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found"
-        )
-
-    if not session:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="No active session found"
-        )
+    if updated is None:
+        return
     
-    return {"user": user, "session": session}
+    # Broadcast threat update via WebSocket
+    score = updated["threat_score"]
+    await websocket_manager.send_threat_update(
+        user_id,
+        {"score": score, "triggers": [FACE_MISMATCH_TRIGGER]},
+        ThreatEngine.should_trigger_facial_captcha(score)
+    )
 
 
 @router.post("/check", response_model=FaceVerificationResponse)
 async def verify_face(
     request: FaceVerificationRequest,
-    current: dict = Depends(get_current_user),
+    background: BackgroundTasks,
+    current: dict = Depends(get_current_user_with_session),
     db: AsyncIOMotorDatabase = Depends(get_database)
 ):
     """
@@ -111,10 +111,9 @@ async def verify_face(
             message="No stored face embedding for comparison"
         )
     
-    # Decrypt stored embedding
-    from ..core.security import decrypt_embedding
+    # Decrypt stored embedding (cached per ciphertext)
     try:
-        stored_embedding = decrypt_embedding(stored_embedding_encrypted)
+        stored_embedding = await get_cached_embedding_async(stored_embedding_encrypted)
     except Exception as e:
         print(f"Failed to decrypt face embedding: {e}")
         return FaceVerificationResponse(
@@ -125,45 +124,28 @@ async def verify_face(
         )
     
     # Calculate distance
-    distance = calculate_face_distance(request.live_embedding, stored_embedding)
+    live_embedding = np.asarray(request.live_embedding, dtype=np.float32)
+    distance_sq = await face_distance_batcher.distance_sq(live_embedding, stored_embedding)
     
-    # Threshold for face match (same as registration/login)
-    FACE_MATCH_THRESHOLD = 0.55
-    matched = distance < FACE_MATCH_THRESHOLD
+    # Threshold for face match (same as registration/login), compared squared
+    matched = distance_sq < FACE_DISTANCE_THRESHOLD_SQ
     
     # Determine threat increase
     threat_increase = 0 if matched else 50  # High penalty for face mismatch
     
-    # Update session threat score if mismatch
+    # Update session threat score if mismatch (after the response is sent)
     if not matched and session:
-        current_threat = session.get("threat_score", 0)
-        new_threat = min(100, current_threat + threat_increase)
-        
-        await db.sessions.update_one(
-            {"_id": session["_id"]},
-            {
-                "$set": {"threat_score": new_threat},
-                "$push": {"threat_triggers": "face_mismatch"}
-            }
-        )
-        
-        # Broadcast threat update via WebSocket
-        user_id = str(user["_id"])
-        await websocket_manager.send_personal_message(
-            user_id,
-            {
-                "type": "threat_update",
-                "data": {
-                    "score": new_threat,
-                    "triggers": ["face_mismatch"],
-                    "message": "⚠️ Face mismatch detected!"
-                }
-            }
+        background.add_task(
+            record_face_mismatch,
+            db,
+            session["_id"],
+            str(user["_id"]),
+            threat_increase
         )
     
     return FaceVerificationResponse(
         matched=matched,
-        distance=round(distance, 4),
+        distance=round(math.sqrt(distance_sq), 4),
         threat_increase=threat_increase,
         message="Face matched" if matched else "Face mismatch detected"
     )
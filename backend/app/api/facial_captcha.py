@@ -4,97 +4,80 @@ Facial CAPTCHA API Endpoints
 Handles challenge generation and verification for facial CAPTCHA system.
 """
 
-from fastapi import APIRouter, Depends, HTTPException, status, Header
-from motor.motor_asyncio import AsyncIOMotorDatabase
-from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import ORJSONResponse
+from pymongo import ReturnDocument
 
-from ..core.database import get_database
-from ..core.security import decode_token
+from ..api.deps import get_current_user_with_session
 from ..core.liveness_detector import (
-    generate_challenge, verify_liveness, validate_challenge_history,
-    record_challenge_attempt, get_recent_failures
+    generate_challenge, verify_liveness, record_challenge_attempt,
+    validate_challenge_history, get_challenge_validation_and_failures
 )
+from ..core.rate_limit import check_and_record
 from ..core.face_verification import (
-    is_face_recognition_available, verify_face_match, validate_embedding_quality
+    is_face_recognition_available, verify_face_match, validate_embedding_quality,
+    embedding_array
 )
 from ..core.config import settings
 from ..api.models import (
     FacialCaptchaChallenge, FacialCaptchaVerifyRequest, FacialCaptchaVerifyResponse
 )
 
-router = APIRouter(prefix="/api/facial-captcha", tags=["Facial CAPTCHA"])
+router = APIRouter(prefix="/api/facial-captcha", tags=["Facial CAPTCHA"], default_response_class=ORJSONResponse)
 
+# Window for counting failed attempts against MAX_CAPTCHA_ATTEMPTS
+CAPTCHA_FAILURE_WINDOW_SECONDS = 10 * 60
 
-async def get_current_user(
-    authorization: Optional[str] = Header(None),
-    db: AsyncIOMotorDatabase = Depends(get_database)
-):
-    """Get current authenticated user and session from token"""
-    import logging
-    logger = logging.getLogger(__name__)
-    
-    logger.info(f"[Auth] Authorization header: {authorization[:50] if authorization else 'None'}")
-    
-    if not authorization or not authorization.startswith("Bearer "):
-        logger.warning("[Auth] Missing or invalid authorization header")
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Missing authentication"
-        )
-    
-    token = authorization.split(" ")[1]
-    logger.info(f"[Auth] Token extracted, length: {len(token)}")
-    
-    payload = decode_token(token)
-    
-    if not payload:
-        logger.warning("[Auth] Token decode failed")
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid token"
-        )
-    
-    user_id = payload.get("sub")
-    session_id = payload.get("session_id")
-    logger.info(f"[Auth] User ID from token: {user_id}")
-    
-    # Convert string ID to ObjectId for MongoDB query
-    from bson import ObjectId
-    try:
-        object_id = ObjectId(user_id)
-        session_object_id = ObjectId(session_id) if session_id else None
-        logger.info(f"[Auth] Converted to ObjectId: {object_id}")
-    except Exception as e:
-        logger.error(f"[Auth] ObjectId conversion failed: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid user ID"
-        )
-    
-    user = await db.users.find_one({"_id": object_id})
-    session = await db.sessions.find_one({"_id": session_object_id}) if session_object_id else None
-    
-    if not user:
-        logger.warning(f"[Auth] User not found for ID: {object_id}")
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found"
-        )
-    
-    if not session:
-        logger.warning(f"[Auth] Session not found for ID: {session_object_id}")
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="No active session found"
-        )
-    
-    logger.info(f"[Auth] User authenticated: {user.get('username')}")
-    return {"user": user, "session": session}
+# Threat score penalty for a failed challenge
+CAPTCHA_FAILURE_PENALTY = 45
+
+# Penalty is computed server-side so concurrent requests can't overwrite
+# each other's increments
+_PENALTY_STAGE = {
+    "$set": {
+        "threat_score": {
+            "$min": [100, {"$add": [{"$ifNull": ["$threat_score", 0]}, CAPTCHA_FAILURE_PENALTY]}]
+        }
+    }
+}
+
+# Stored score no longer matches the last heartbeat's inputs
+_CLEAR_FINGERPRINT_STAGE = {"$unset": "signals_fingerprint"}
+
+# Verdict -> (success, message, session update); each verdict is a single write
+VERDICTS = {
+    # Clear CAPTCHA requirement and unlock session
+    "PASS": (
+        True,
+        "Facial CAPTCHA verified successfully",
+        {
+            "$set": {"requires_facial_captcha": False, "is_locked": False},
+            # Force the next heartbeat to be fully scored
+            "$unset": {"signals_fingerprint": ""}
+        }
+    ),
+    # Face matched but liveness failed: penalty only
+    "HIGH_RISK": (
+        False,
+        "Liveness verification failed: {reason}",
+        [_PENALTY_STAGE, _CLEAR_FINGERPRINT_STAGE]
+    ),
+    # Face mismatch: penalty and potentially lock session
+    "FAIL": (
+        False,
+        "Face verification failed",
+        [
+            _PENALTY_STAGE,
+            _CLEAR_FINGERPRINT_STAGE,
+            {"$set": {"is_locked": {"$gte": ["$threat_score", settings.THREAT_LOCK_THRESHOLD]}}}
+        ]
+    )
+}
 
 
 @router.get("/challenge", response_model=FacialCaptchaChallenge)
 async def get_challenge(
-    current: dict = Depends(get_current_user)
+    current: dict = Depends(get_current_user_with_session)
 ):
     """
     Generate a random facial CAPTCHA challenge
@@ -106,8 +89,7 @@ async def get_challenge(
 @router.post("/verify", response_model=FacialCaptchaVerifyResponse)
 async def verify_challenge(
     verification: FacialCaptchaVerifyRequest,
-    current: dict = Depends(get_current_user),
-    db: AsyncIOMotorDatabase = Depends(get_database)
+    current: dict = Depends(get_current_user_with_session)
 ):
     """
     Verify facial CAPTCHA challenge response
@@ -119,29 +101,43 @@ async def verify_challenge(
     """
     user = current["user"]
     session = current["session"]
+    db = current["db"]
     user_id = str(user["_id"])
     
-    # Check if already used (prevent replay)
-    is_valid_challenge = await validate_challenge_history(
-        db, user_id, verification.challenge_id
+    # Recent failure count (rate limiting) from the Redis rolling window
+    failure_limit = await check_and_record(
+        user_id, "captcha_fail", settings.MAX_CAPTCHA_ATTEMPTS,
+        CAPTCHA_FAILURE_WINDOW_SECONDS, record=False
     )
     
+    if failure_limit is not None:
+        is_valid_challenge = await validate_challenge_history(
+            db, user_id, verification.challenge_id
+        )
+        rate_limited = not failure_limit[0]
+    else:
+        # No Redis: replay check and failure count in one query
+        is_valid_challenge, recent_failures = await get_challenge_validation_and_failures(
+            db, user_id, verification.challenge_id,
+            window_minutes=CAPTCHA_FAILURE_WINDOW_SECONDS // 60
+        )
+        rate_limited = recent_failures >= settings.MAX_CAPTCHA_ATTEMPTS
+    
     if not is_valid_challenge:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Challenge already used or invalid"
         )
     
-    # Check recent failures (rate limiting)
-    recent_failures = await get_recent_failures(db, user_id, window_minutes=10)
-    if recent_failures >= settings.MAX_CAPTCHA_ATTEMPTS:
+    if rate_limited:
         raise HTTPException(
             status_code=status.HTTP_429_TOO_MANY_REQUESTS,
             detail=f"Too many failed attempts. Account temporarily locked."
         )
     
     # Validate embedding
-    is_valid_embedding, error_msg = validate_embedding_quality(verification.face_embedding)
+    face_embedding = embedding_array(verification.face_embedding)
+    is_valid_embedding, error_msg = validate_embedding_quality(face_embedding)
     if not is_valid_embedding:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -160,7 +156,6 @@ async def verify_challenge(
     
     # Step 2: Verify face match
     face_matched = False
-    verdict = "FAIL"
     
     if not user.get("face_embedding_encrypted"):
         # No face enrolled, skip face matching
@@ -168,7 +163,7 @@ async def verify_challenge(
     else:
         if is_face_recognition_available():
             match_result, similarity, match_verdict = verify_face_match(
-                verification.face_embedding,
+                face_embedding,
                 user["face_embedding_encrypted"]
             )
             face_matched = match_result
@@ -177,55 +172,27 @@ async def verify_challenge(
             face_matched = True
     
     # Step 3: Determine final verdict
-    if face_matched and liveness_verified:
-        verdict = "PASS"
-        success = True
-        message = "Facial CAPTCHA verified successfully"
-        
-        # Update session
-        await db.sessions.update_one(
-            {"_id": session["_id"]},
-            {
-                "$set": {
-                    "requires_facial_captcha": False,
-                    "is_locked": False
-                }
-            }
-        )
-    
-    elif face_matched and not liveness_verified:
-        verdict = "HIGH_RISK"
-        success = False
-        message = f"Liveness verification failed: {liveness_result['reason']}"
-        
-        # Apply penalty to threat score
-        current_threat = session.get("threat_score", 0)
-        new_threat = min(current_threat + 45, 100)
-        
-        await db.sessions.update_one(
-            {"_id": session["_id"]},
-            {"$set": {"threat_score": new_threat}}
-        )
-    
+    if face_matched:
+        verdict = "PASS" if liveness_verified else "HIGH_RISK"
     else:
         verdict = "FAIL"
-        success = False
-        message = "Face verification failed"
-        
-        # Apply penalty and potentially lock session
-        current_threat = session.get("threat_score", 0)
-        new_threat = min(current_threat + 45, 100)
-        
-        should_lock = new_threat >= settings.THREAT_LOCK_THRESHOLD
-        
-        await db.sessions.update_one(
-            {"_id": session["_id"]},
-            {
-                "$set": {
-                    "threat_score": new_threat,
-                    "is_locked": should_lock
-                }
-            }
+    
+    success, message_template, session_update = VERDICTS[verdict]
+    message = message_template.format(reason=liveness_result.get("reason"))
+    
+    refreshed_session = await db.sessions.find_one_and_update(
+        {"_id": session["_id"]},
+        session_update,
+        projection={"threat_score": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    new_threat_score = refreshed_session.get("threat_score", 0) if refreshed_session else 0
+    
+    # Record failures in the rolling window (no-op without Redis)
+    if not success:
+        await check_and_record(
+            user_id, "captcha_fail", settings.MAX_CAPTCHA_ATTEMPTS,
+            CAPTCHA_FAILURE_WINDOW_SECONDS
         )
     
     # Record attempt
@@ -239,10 +206,6 @@ async def verify_challenge(
         face_matched=face_matched
     )
     
-    # Get updated threat score
-    refreshed_session = await db.sessions.find_one({"_id": session["_id"]})
-    new_threat_score = refreshed_session.get("threat_score", 0) if refreshed_session else 0
-    
     return FacialCaptchaVerifyResponse(
         success=success,
         verdict=verdict,
@@ -2,9 +2,17 @@
 Pydantic models for request/response validation
 """
 
-from pydantic import BaseModel, EmailStr, Field, validator
-from typing import Optional, List
+from pydantic import BaseModel, EmailStr, Field, model_validator
+from typing import Annotated, Optional, List
 from datetime import datetime
+import base64
+import binascii
+
+from ..core.security import unpack_quantized_embedding
+
+
+# 128-dim face embedding; the length bounds compile into the core list validator
+FaceEmbedding = Annotated[List[float], Field(min_length=128, max_length=128)]
 
 
 # ============================================================================
@@ -19,13 +27,7 @@ class UserRegister(BaseModel):
     name: str = Field(..., min_length=1, max_length=100)
     account_no: str = Field(..., min_length=10, max_length=20)
     mobile: str = Field(..., pattern=r"^\+?\d{10,15}$")
-    face_embedding: Optional[List[float]] = None  # 128-dim array
-    
-    @validator('face_embedding')
-    def validate_embedding(cls, v):
-        if v is not None and len(v) != 128:
-            raise ValueError('Face embedding must be 128-dimensional')
-        return v
+    face_embedding: Optional[FaceEmbedding] = None  # 128-dim array
 
 
 class UserLogin(BaseModel):
@@ -39,7 +41,7 @@ class UserLogin(BaseModel):
 
 class FaceAutoLogin(BaseModel):
     """Face-based auto-login request"""
-    face_embedding: List[float] = Field(..., min_length=128, max_length=128)
+    face_embedding: FaceEmbedding
     device_fingerprint: str
     ip_address: str
     user_agent: str
@@ -85,7 +87,24 @@ class FacialCaptchaVerifyRequest(BaseModel):
     challenge_result: bool  # Did user complete the action?
     timing_seconds: float
     liveness_score: float  # 0-1
-    face_embedding: List[float] = Field(..., min_length=128, max_length=128)
+    face_embedding: Optional[FaceEmbedding] = None
+    # Compact alternative to face_embedding: base64 of a float32 (LE) scale
+    # followed by 128 int8 values
+    face_embedding_q8: Optional[str] = None
+    
+    @model_validator(mode="before")
+    @classmethod
+    def decode_quantized_embedding(cls, values):
+        if isinstance(values, dict) and values.get("face_embedding") is None:
+            packed = values.get("face_embedding_q8")
+            if not packed:
+                raise ValueError("face_embedding or face_embedding_q8 is required")
+            try:
+                embedding = unpack_quantized_embedding(base64.b64decode(packed, validate=True))
+            except (binascii.Error, ValueError) as e:
+                raise ValueError(f"Invalid face_embedding_q8: {e}")
+            values = {**values, "face_embedding": embedding.tolist()}
+        return values
 
 
 class FacialCaptchaVerifyResponse(BaseModel):
@@ -152,11 +171,11 @@ class AccountBalanceResponse(BaseModel):
 class Transaction(BaseModel):
     """Transaction model"""
     transaction_id: str
-    type: str  # CREDIT | DEBIT
-    amount: float
-    description: str
+    type: str = "DEBIT"  # CREDIT | DEBIT
+    amount: float = 0.0
+    description: str = ""
     timestamp: datetime
-    balance_after: float
+    balance_after: float = 0.0
 
 
 class PaymentRequest(BaseModel):
@@ -182,6 +201,6 @@ class SessionInfo(BaseModel):
     """Session information"""
     session_id: str
     user_id: str
-    created_at: str
+    created_at: datetime
     threat_score: float
     is_locked: bool
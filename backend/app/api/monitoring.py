@@ -4,74 +4,114 @@ Continuous Monitoring API
 Handles behavioral heartbeat signals and threat score calculation.
 """
 
-from fastapi import APIRouter, Depends, HTTPException, status, Header
-from motor.motor_asyncio import AsyncIOMotorDatabase
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse
+from datetime import datetime
 from typing import Optional
+import hashlib
+import logging
+from pydantic import ValidationError
 
-from ..core.database import get_database
-from ..core.security import decode_token, decrypt_embedding
+from ..core.face_verification import get_cached_embedding_async, embedding_array
+from ..api.deps import get_current_user
 from ..core.threat_engine import ThreatEngine
+from ..core.behavioral_writer import behavioral_writer
 from ..core.config import settings
 from ..api.models import HeartbeatRequest, ThreatScoreResponse
 
-router = APIRouter(prefix="/api/monitoring", tags=["Monitoring"])
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/api/monitoring", tags=["Monitoring"], default_response_class=ORJSONResponse)
 
 @router.get("/ping")
 async def ping():
     return {"status": "ok", "message": "Monitoring router is active"}
 
 
-async def get_current_user(
-    authorization: Optional[str] = Header(None),
-    db: AsyncIOMotorDatabase = Depends(get_database)
-):
-    """Get current authenticated user"""
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Missing authentication"
-        )
-    
-    token = authorization.split(" ")[1]
-    payload = decode_token(token)
+# Heartbeat body schema for the OpenAPI docs (BehavioralSignals inlined, as
+# the route parses the body itself and FastAPI won't register the models)
+_HEARTBEAT_SCHEMA = HeartbeatRequest.model_json_schema()
+_HEARTBEAT_SCHEMA["properties"]["signals"] = _HEARTBEAT_SCHEMA.pop("$defs")["BehavioralSignals"]
+
+
+async def parse_heartbeat(request: Request) -> HeartbeatRequest:
+    """
+    Validate the raw heartbeat body straight from JSON
     
-    if not payload:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid token"
+    model_validate_json parses and validates in one pass in pydantic-core,
+    skipping the intermediate dict FastAPI's body handling builds.
+    """
+    try:
+        return HeartbeatRequest.model_validate_json(await request.body())
+    except ValidationError as e:
+        # Same 422 shape as FastAPI's own body validation
+        raise RequestValidationError(
+            [{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)]
         )
+
+
+def _signals_fingerprint(current_signals: dict, created_at) -> Optional[str]:
+    """
+    Digest of every threat-score input for camera-off heartbeats
     
-    user_id = payload.get("sub")
-    session_id = payload.get("session_id")
+    Returns None when the heartbeat must always be scored (camera on or a
+    live embedding present). Session device/IP/browser are fixed per
+    session; the session age enters via its score bucket.
+    """
+    if current_signals["camera_ready"] or current_signals["live_face_embedding"] is not None:
+        return None
     
-    # Convert string IDs to ObjectId for MongoDB query
-    from bson import ObjectId
-    try:
-        user_object_id = ObjectId(user_id)
-        session_object_id = ObjectId(session_id) if session_id else None
-    except:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid ID"
-        )
+    key = (
+        tuple(v for k, v in current_signals.items() if k != "live_face_embedding"),
+        ThreatEngine._check_session_age(created_at)
+    )
+    return hashlib.blake2b(repr(key).encode(), digest_size=8).hexdigest()
+
+
+async def _replay_threat_score(db, user: dict, session: dict, heartbeat: HeartbeatRequest):
+    """Answer an unchanged camera-off heartbeat from the stored session score"""
+    score = session["threat_score"]
+    timestamp = datetime.utcnow()
     
-    user = await db.users.find_one({"_id": user_object_id})
-    session = await db.sessions.find_one({"_id": session_object_id}) if session_object_id else None
+    behavioral_writer.enqueue({
+        "user_id": str(user["_id"]),
+        "session_id": str(session["_id"]),
+        "signals": heartbeat.signals.model_dump(
+            exclude={"live_face_embedding"}, exclude_none=True
+        ),
+        "threat_score": score,
+        "timestamp": timestamp
+    })
     
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found"
-        )
+    await db.sessions.update_one(
+        {"_id": session["_id"]},
+        {"$set": {"last_heartbeat": timestamp.isoformat()}}
+    )
     
-    return {"user": user, "session": session}
+    return ThreatScoreResponse(
+        score=score,
+        breakdown=session.get("threat_breakdown", {}),
+        triggers=session.get("threat_triggers", []),
+        recommended_action=ThreatEngine._get_recommended_action(score),
+        timestamp=timestamp.isoformat(),
+        requires_facial_captcha=ThreatEngine.should_trigger_facial_captcha(score)
+    )
 
 
-@router.post("/heartbeat", response_model=ThreatScoreResponse)
+@router.post(
+    "/heartbeat",
+    response_model=ThreatScoreResponse,
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": _HEARTBEAT_SCHEMA}}
+        }
+    }
+)
 async def process_heartbeat(
-    heartbeat: HeartbeatRequest,
-    current: dict = Depends(get_current_user),
-    db: AsyncIOMotorDatabase = Depends(get_database)
+    heartbeat: HeartbeatRequest = Depends(parse_heartbeat),
+    current: dict = Depends(get_current_user)
 ):
     """
     Process behavioral heartbeat signals and calculate threat score
@@ -79,9 +119,10 @@ async def process_heartbeat(
     """
     user = current["user"]
     session = current["session"]
+    db = current["db"]
     
     if not session:
-        print(f"DEBUG: Session failed for user {user.get('_id')}")
+        logger.debug("Heartbeat without active session for user %s", user.get("_id"))
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="No active session found"
@@ -94,24 +135,11 @@ async def process_heartbeat(
             detail="Session is locked. Please complete facial CAPTCHA."
         )
     
-    # Prepare session data
-    stored_face_embedding = None
-    if user.get("face_embedding_encrypted"):
-        try:
-            stored_face_embedding = decrypt_embedding(user.get("face_embedding_encrypted"))
-        except Exception as e:
-            print(f"Failed to decrypt stored face embedding: {e}")
-
-    session_data = {
-        "device_fingerprint": session.get("device_fingerprint"),
-        "ip_address": session.get("ip_address"),
-        "browser_signature": session.get("browser_signature"),
-        "created_at": session.get("created_at"),
-        "stored_face_embedding": stored_face_embedding
-    }
-    
     # Current signals from heartbeat
     camera_ready = heartbeat.signals.camera_ready is True
+    live_face_embedding = heartbeat.signals.live_face_embedding
+    if live_face_embedding is not None:
+        live_face_embedding = embedding_array(live_face_embedding)
     current_signals = {
         "device_fingerprint": heartbeat.signals.device_fingerprint,
         "ip_address": heartbeat.signals.ip_address,
@@ -124,7 +152,33 @@ async def process_heartbeat(
         "facial_captcha_failed": heartbeat.signals.facial_captcha_failed,
         "mouse_entropy": heartbeat.signals.mouse_entropy,
         "mouse_velocity_variance": heartbeat.signals.mouse_velocity_variance,
-        "live_face_embedding": heartbeat.signals.live_face_embedding
+        "live_face_embedding": live_face_embedding
+    }
+    
+    # Camera off and nothing that feeds the score changed since the last
+    # scored heartbeat: the engine would reproduce the stored result
+    fingerprint = _signals_fingerprint(current_signals, session.get("created_at"))
+    if (
+        fingerprint is not None
+        and session.get("signals_fingerprint") == fingerprint
+        and session.get("threat_score") is not None
+    ):
+        return await _replay_threat_score(db, user, session, heartbeat)
+    
+    # Prepare session data
+    stored_face_embedding = None
+    if user.get("face_embedding_encrypted"):
+        try:
+            stored_face_embedding = await get_cached_embedding_async(user.get("face_embedding_encrypted"))
+        except Exception as e:
+            logger.warning("Failed to decrypt stored face embedding: %s", e)
+
+    session_data = {
+        "device_fingerprint": session.get("device_fingerprint"),
+        "ip_address": session.get("ip_address"),
+        "browser_signature": session.get("browser_signature"),
+        "created_at": session.get("created_at"),
+        "stored_face_embedding": stored_face_embedding
     }
     
     # Get ML anomaly score (placeholder - would integrate actual ML model)
@@ -184,28 +238,20 @@ async def process_heartbeat(
         "threat_triggers": threat_result["triggers"],
         "threat_breakdown": threat_result["breakdown"],
         "no_face_streak": no_face_streak,
-        "multi_face_streak": multi_face_streak
+        "multi_face_streak": multi_face_streak,
+        "signals_fingerprint": fingerprint
     }
 
-    # Broadcast threat update via WebSocket - FIXED PARAMETER ORDER
+    # Broadcast threat update via WebSocket
     try:
         from ..sockets.websocket_manager import websocket_manager
-        user_id = str(user["_id"])
-        # Correct order: send_personal_message(user_id, message)
-        await websocket_manager.send_personal_message(
-            user_id,
-            {
-                "type": "threat_update",
-                "data": {
-                    **threat_result,
-                    "requires_facial_captcha": ThreatEngine.should_trigger_facial_captcha(
-                        threat_result["score"]
-                    ) or force_lock
-                }
-            }
+        await websocket_manager.send_threat_update(
+            str(user["_id"]),
+            threat_result,
+            ThreatEngine.should_trigger_facial_captcha(threat_result["score"]) or force_lock
         )
     except Exception as e:
-        print(f"Failed to broadcast threat update: {e}")
+        logger.warning("Failed to broadcast threat update: %s", e)
     
     # Take action based on threat level
     if force_lock:
@@ -234,13 +280,17 @@ async def process_heartbeat(
     if requires_captcha:
         update_data["requires_facial_captcha"] = True
     
-    # Save behavioral data
-    await db.behavioral_data.insert_one({
+    # Save behavioral data (audit only, batched by the background writer)
+    behavioral_writer.enqueue({
         "user_id": str(user["_id"]),
         "session_id": str(session["_id"]),
-        "signals": heartbeat.signals.dict(),
+        # Embedding is only needed for the live check, not worth ~1 KB per heartbeat
+        "signals": heartbeat.signals.model_dump(
+            exclude={"live_face_embedding"}, exclude_none=True
+        ),
         "threat_score": threat_result["score"],
-        "timestamp": threat_result["timestamp"]
+        # BSON date (not the ISO string) so the TTL index can expire it
+        "timestamp": datetime.utcnow()
     })
     
     # Update session
@@ -257,8 +307,7 @@ async def process_heartbeat(
 
 @router.get("/threat-score", response_model=ThreatScoreResponse)
 async def get_threat_score(
-    current: dict = Depends(get_current_user),
-    db: AsyncIOMotorDatabase = Depends(get_database)
+    current: dict = Depends(get_current_user)
 ):
     """Get current threat score for session"""
     session = current["session"]
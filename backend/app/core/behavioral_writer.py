@@ -0,0 +1,96 @@
+"""
+Behavioral Data Writer
+
+Coalesces heartbeat audit records into batched insert_many calls.
+Handlers enqueue documents without awaiting MongoDB; a single worker
+started in the app lifespan drains the queue.
+"""
+
+import asyncio
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class BehavioralDataWriter:
+    """Bounded queue of behavioral_data documents flushed by one worker"""
+
+    def __init__(
+        self,
+        max_queue: int = 10_000,
+        max_batch: int = 500,
+        flush_interval: float = 0.1
+    ):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._task: Optional[asyncio.Task] = None
+        self._db = None
+
+    def enqueue(self, document: dict):
+        """Queue a document for insertion, dropping it if the queue is full"""
+        try:
+            self._queue.put_nowait(document)
+        except asyncio.QueueFull:
+            # Audit-only data, shedding beats blocking heartbeats
+            logger.warning("Behavioral data queue full, dropping record")
+
+    def start(self, db):
+        """Start the background flush worker"""
+        self._db = db
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the worker and flush whatever is still queued"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        while not self._queue.empty():
+            await self._flush(self._drain_nowait())
+
+    def _drain_nowait(self) -> list:
+        """Take up to max_batch queued documents without waiting"""
+        batch = []
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
+
+    async def _run(self):
+        """Wait for a document, collect more for up to flush_interval, insert"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            await self._flush(batch)
+
+    async def _flush(self, batch: list):
+        """Insert a batch; unordered so one bad document doesn't drop the rest"""
+        if not batch:
+            return
+        try:
+            await self._db.behavioral_data.insert_many(batch, ordered=False)
+        except Exception as e:
+            logger.error(f"Failed to write {len(batch)} behavioral records: {e}")
+
+
+# Global writer instance
+behavioral_writer = BehavioralDataWriter()
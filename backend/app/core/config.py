@@ -1,5 +1,5 @@
 from pydantic_settings import BaseSettings
-from typing import List
+from typing import List, Optional
 
 
 class Settings(BaseSettings):
@@ -8,15 +8,25 @@ class Settings(BaseSettings):
     # MongoDB Configuration
     MONGODB_URL: str = "mongodb://localhost:27017"
     DATABASE_NAME: str = "intellisecure_bank"
+    MONGODB_MAX_POOL_SIZE: int = 200
+    MONGODB_MIN_POOL_SIZE: int = 20
+    MONGODB_SERVER_SELECTION_TIMEOUT_MS: int = 2000
+    MONGODB_COMPRESSORS: str = "zstd,zlib"  # Wire compression, first supported wins
+    
+    # Redis Configuration (optional, shares state across workers)
+    REDIS_URL: Optional[str] = None
+    REDIS_MAX_CONNECTIONS: int = 100
     
     # JWT Configuration
     SECRET_KEY: str
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
     REFRESH_TOKEN_EXPIRE_DAYS: int = 7
+    TOKEN_SNAPSHOT_TTL_SECONDS: int = 5  # How long the state snapshot in a token is trusted
     
     # Security
     AES_ENCRYPTION_KEY: str
+    ARGON2_TIME_COST: int = 3  # Same on every worker; measure with python -m app.core.security
     
     # CORS
     CORS_ORIGINS: str = "http://localhost:3000,http://localhost:5173"
@@ -30,11 +40,22 @@ class Settings(BaseSettings):
     FACE_SUSPICIOUS_THRESHOLD: float = 0.70
     LIVENESS_SCORE_THRESHOLD: float = 0.7
     MAX_CAPTCHA_ATTEMPTS: int = 3
+    FACE_INDEX_REBUILD_INTERVAL: int = 300  # seconds
+    EMBEDDING_CACHE_TTL_SECONDS: int = 900  # Decrypted stored embeddings
+    
+    # WebSocket
+    WS_BINARY_THREAT_UPDATES: bool = False  # Compact binary threat frames instead of JSON
+    
+    # Server (python main.py)
+    UVICORN_WORKERS: int = 1  # >1 disables auto-reload; set REDIS_URL for WebSocket delivery
     
     # Rate Limiting
     LOGIN_RATE_LIMIT: int = 5
     LOGIN_RATE_WINDOW: int = 300  # seconds
     
+    # Data Retention
+    BEHAVIORAL_DATA_TTL_DAYS: int = 7  # Heartbeat history kept for audit
+    
     # ML Configuration
     ML_MODEL_PATH: str = "app/ml/models/isolation_forest.pkl"
     
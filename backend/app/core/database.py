@@ -1,5 +1,7 @@
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import IndexModel, ASCENDING, DESCENDING
 from .config import settings
+import asyncio
 import logging
 
 logger = logging.getLogger(__name__)
@@ -9,33 +11,89 @@ class Database:
     """MongoDB async database connection manager"""
     
     client: AsyncIOMotorClient = None
+    db = None
     
     @classmethod
     async def connect_db(cls):
         """Connect to MongoDB"""
         try:
-            cls.client = AsyncIOMotorClient(settings.MONGODB_URL)
+            cls.client = AsyncIOMotorClient(
+                settings.MONGODB_URL,
+                maxPoolSize=settings.MONGODB_MAX_POOL_SIZE,
+                minPoolSize=settings.MONGODB_MIN_POOL_SIZE,
+                serverSelectionTimeoutMS=settings.MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+                compressors=settings.MONGODB_COMPRESSORS
+            )
+            cls.db = cls.client[settings.DATABASE_NAME]
             # Verify connection
             await cls.client.admin.command('ping')
             logger.info(f"Connected to MongoDB at {settings.MONGODB_URL}")
         except Exception as e:
             logger.error(f"Failed to connect to MongoDB: {e}")
             raise
+        
+        await cls.warm_pool()
+        await cls.create_indexes()
+    
+    @classmethod
+    async def warm_pool(cls):
+        """Open pooled connections up front so first requests don't pay for them"""
+        warmups = [cls.db.command('ping') for _ in range(settings.MONGODB_MIN_POOL_SIZE)]
+        warmups.append(cls.db.users.find_one({}, {"_id": 1}))
+        await asyncio.gather(*warmups, return_exceptions=True)
+    
+    @classmethod
+    async def create_indexes(cls):
+        """Declare indexes for the hot query shapes (no-op if they exist)"""
+        db = cls.get_db()
+        # Separate so existing duplicate users can't block the other indexes
+        try:
+            await db.users.create_indexes([
+                IndexModel([("username", ASCENDING)], unique=True),
+                IndexModel([("email", ASCENDING)], unique=True)
+            ])
+        except Exception as e:
+            logger.error(f"Failed to create unique user indexes (duplicate usernames/emails?): {e}")
+        
+        try:
+            # Covers get_transactions: equality on user_id, sorted by newest
+            await db.transactions.create_index(
+                [("user_id", ASCENDING), ("timestamp", DESCENDING)]
+            )
+            # CAPTCHA replay check (user_id, challenge_id) and windowed failure count
+            await db.facial_captcha_history.create_indexes([
+                IndexModel([("user_id", ASCENDING), ("challenge_id", ASCENDING)]),
+                IndexModel([("user_id", ASCENDING), ("timestamp", DESCENDING)])
+            ])
+            # Heartbeat history per session, expired after the retention window
+            await db.behavioral_data.create_indexes([
+                IndexModel([("session_id", ASCENDING), ("timestamp", DESCENDING)]),
+                IndexModel(
+                    [("timestamp", ASCENDING)],
+                    expireAfterSeconds=settings.BEHAVIORAL_DATA_TTL_DAYS * 86400
+                )
+            ])
+            logger.info("MongoDB indexes ensured")
+        except Exception as e:
+            logger.error(f"Failed to create MongoDB indexes: {e}")
     
     @classmethod
     async def close_db(cls):
         """Close MongoDB connection"""
         if cls.client:
             cls.client.close()
+            cls.client = None
+            cls.db = None
             logger.info("Closed MongoDB connection")
     
     @classmethod
     def get_db(cls):
         """Get database instance"""
-        return cls.client[settings.DATABASE_NAME]
+        return cls.db
 
 
-# Convenience function for dependency injection
-def get_database():
+# Convenience function for dependency injection (async so FastAPI calls it
+# inline instead of dispatching it to the threadpool)
+async def get_database():
     """FastAPI dependency to get database"""
-    return Database.get_db()
+    return Database.db
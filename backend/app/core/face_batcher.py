@@ -0,0 +1,81 @@
+"""
+Face Distance Micro-Batcher
+
+Coalesces concurrent live-vs-stored distance computations from the
+continuous face verification endpoint into a single vectorized kernel.
+"""
+
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class FaceDistanceBatcher:
+    """Collect distance requests for a short window and compute them in one pass"""
+
+    def __init__(self, window_seconds: float = 0.005, max_batch: int = 256):
+        self.window_seconds = window_seconds
+        self.max_batch = max_batch
+        self._pending: List[Tuple[np.ndarray, np.ndarray, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    async def distance_sq(self, live_embedding, stored_embedding) -> float:
+        """
+        Squared Euclidean distance between two embeddings, computed in a batch
+
+        Args:
+            live_embedding: 128-dim face embedding from live camera
+            stored_embedding: 128-dim stored face embedding
+
+        Returns:
+            Squared Euclidean distance (lower = more similar)
+        """
+        live = np.asarray(live_embedding, dtype=np.float32)
+        stored = np.asarray(stored_embedding, dtype=np.float32)
+        if live.shape != stored.shape:
+            raise ValueError(f"Embedding shape mismatch: {live.shape} vs {stored.shape}")
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((live, stored, future))
+
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window_seconds, self._flush)
+
+        return await future
+
+    def _flush(self):
+        """Compute all pending distances and resolve their futures"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        try:
+            live = np.stack([item[0] for item in batch])
+            stored = np.stack([item[1] for item in batch])
+            diff = live - stored
+            distances_sq = np.einsum("ij,ij->i", diff, diff)
+        except Exception as e:
+            logger.error(f"Batched face distance failed: {e}")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, _, future), distance_sq in zip(batch, distances_sq):
+            if not future.done():
+                future.set_result(float(distance_sq))
+
+
+# Global batcher instance
+face_distance_batcher = FaceDistanceBatcher()
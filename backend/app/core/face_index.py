@@ -0,0 +1,333 @@
+"""
+Face Embedding Index
+
+In-memory nearest-neighbour index over enrolled face embeddings.
+Used by face-based auto-login instead of decrypting and comparing
+every stored embedding on each request.
+
+Embeddings are held int8-quantized with a per-row scale (the same form
+they are stored in), a quarter of the float32 footprint. Uses FAISS when
+installed, otherwise a fused Numba scan or, failing that, a blocked
+NumPy scan.
+"""
+
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from .security import decrypt_embedding_versioned, encrypt_embedding, quantize_embedding
+from . import face_kernels
+
+logger = logging.getLogger(__name__)
+
+# Import will be conditional based on availability
+try:
+    import faiss
+    FAISS_AVAILABLE = True
+except ImportError:
+    FAISS_AVAILABLE = False
+
+EMBEDDING_DIM = 128
+
+# Above this many users switch from exact Flat search to IVF-PQ
+IVFPQ_MIN_USERS = 100_000
+
+# Rows dequantized per step of the NumPy scan; the float32 block (1 MB)
+# stays cache-resident while only int8 codes stream from memory
+SCAN_BLOCK_ROWS = 2048
+
+
+def _decrypt_all(encrypted: List[Tuple[str, str]]) -> Tuple[List[str], list, list, list]:
+    """
+    Decrypt and quantize (user_id, ciphertext) pairs, skipping unreadable ones
+
+    Legacy ciphertexts (stringified list, or the old PBKDF2 key) are
+    re-encrypted in the current format/key and returned as
+    (user_id, old, new) migrations.
+    """
+    user_ids = []
+    codes = []
+    scales = []
+    migrations = []
+    for user_id, ciphertext in encrypted:
+        try:
+            embedding, is_legacy = decrypt_embedding_versioned(ciphertext)
+        except Exception as e:
+            logger.warning(f"Skipping face embedding for user {user_id}: {e}")
+            continue
+        if len(embedding) != EMBEDDING_DIM:
+            continue
+        if is_legacy:
+            migrations.append((user_id, ciphertext, encrypt_embedding(embedding)))
+        quantized, scale = quantize_embedding(embedding)
+        codes.append(quantized)
+        scales.append(scale)
+        user_ids.append(user_id)
+    return user_ids, codes, scales, migrations
+
+
+class FaceIndex:
+    """Nearest-neighbour search over all enrolled face embeddings"""
+
+    def __init__(self):
+        self._index = None
+        # Row-major int8 codes, per-row scales and squared norms are views
+        # into buffers with spare capacity, so enrolling doesn't copy them
+        self._codes_buffer = np.empty((0, EMBEDDING_DIM), dtype=np.int8)
+        self._scales_buffer = np.empty(0, dtype=np.float32)
+        self._norms_buffer = np.empty(0, dtype=np.float32)
+        self._codes = self._codes_buffer
+        self._scales = self._scales_buffer
+        self._norms_sq = self._norms_buffer
+        self.user_ids: List[str] = []
+        self._rows: Dict[str, int] = {}
+        self.is_built = False
+        self._build_lock: Optional[asyncio.Lock] = None
+        # Embeddings added while a build is reading/decrypting its snapshot,
+        # replayed over the rebuilt rows (None: no build in progress)
+        self._adds_during_build: Optional[Dict[str, np.ndarray]] = None
+
+    @staticmethod
+    def _row_norms_sq(codes: np.ndarray, scales: np.ndarray) -> np.ndarray:
+        """Squared norms of the dequantized rows: scale^2 * ||codes||^2"""
+        codes_sq = np.einsum("ij,ij->i", codes, codes, dtype=np.int32)
+        return (scales * scales * codes_sq).astype(np.float32)
+
+    def _set_rows(self, codes: np.ndarray, scales: np.ndarray, user_ids: List[str]):
+        """Replace all rows (buffers sized exactly, grown on demand)"""
+        self._codes_buffer = codes
+        self._scales_buffer = scales
+        self._norms_buffer = self._row_norms_sq(codes, scales)
+        self._codes = self._codes_buffer
+        self._scales = self._scales_buffer
+        self._norms_sq = self._norms_buffer
+        self.user_ids = user_ids
+        self._rows = {user_id: row for row, user_id in enumerate(user_ids)}
+
+    def _write_row(self, row: int, code: np.ndarray, scale: float):
+        """Store one quantized row and its squared norm"""
+        self._codes_buffer[row] = code
+        self._scales_buffer[row] = scale
+        self._norms_buffer[row] = self._row_norms_sq(code[None, :], np.float32([scale]))[0]
+
+    def _append_row(self, user_id: str, code: np.ndarray, scale: float):
+        """Append one row, doubling buffer capacity when full"""
+        n = len(self.user_ids)
+        if n == len(self._codes_buffer):
+            capacity = max(64, 2 * n)
+            codes = np.empty((capacity, EMBEDDING_DIM), dtype=np.int8)
+            codes[:n] = self._codes_buffer[:n]
+            scales = np.empty(capacity, dtype=np.float32)
+            scales[:n] = self._scales_buffer[:n]
+            norms = np.empty(capacity, dtype=np.float32)
+            norms[:n] = self._norms_buffer[:n]
+            self._codes_buffer, self._scales_buffer, self._norms_buffer = codes, scales, norms
+
+        self._write_row(n, code, scale)
+        self._codes = self._codes_buffer[:n + 1]
+        self._scales = self._scales_buffer[:n + 1]
+        self._norms_sq = self._norms_buffer[:n + 1]
+        self._rows[user_id] = n
+        self.user_ids.append(user_id)
+
+    def _dequantized(self, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        """Float32 embeddings for a row range (what FAISS indexes)"""
+        codes = self._codes[start:stop]
+        return codes.astype(np.float32) * self._scales[start:stop, None]
+
+    def _lock(self) -> asyncio.Lock:
+        """Build lock, created lazily inside the running event loop"""
+        if self._build_lock is None:
+            self._build_lock = asyncio.Lock()
+        return self._build_lock
+
+    async def ensure_built(self, db):
+        """Build on first use; concurrent first callers share a single build"""
+        if self.is_built:
+            return
+        async with self._lock():
+            if not self.is_built:
+                await self._build(db)
+
+    async def build(self, db):
+        """Load and decrypt every stored embedding once and (re)build the index"""
+        async with self._lock():
+            await self._build(db)
+
+    async def _build(self, db):
+        """build() body; caller holds the build lock"""
+        self._adds_during_build = {}
+        try:
+            await self._load_rows(db)
+        finally:
+            adds, self._adds_during_build = self._adds_during_build, None
+        # The snapshot predates these enrollments: apply them on top
+        for user_id, embedding in adds.items():
+            self.add(user_id, embedding)
+        self.is_built = True
+        logger.info(f"Face index built with {len(self.user_ids)} embeddings")
+
+    async def _load_rows(self, db):
+        """Replace all rows with a decrypted snapshot of the stored embeddings"""
+        users_cursor = db.users.find(
+            {"face_embedding_encrypted": {"$ne": None}},
+            projection={"face_embedding_encrypted": 1}
+        )
+
+        encrypted = [
+            (str(user["_id"]), user["face_embedding_encrypted"])
+            async for user in users_cursor
+        ]
+
+        # Bulk decryption is CPU-bound, keep it off the event loop
+        loop = asyncio.get_running_loop()
+        user_ids, codes, scales, migrations = await loop.run_in_executor(
+            None, _decrypt_all, encrypted
+        )
+        if migrations:
+            await self._migrate_legacy(db, migrations)
+
+        if codes:
+            code_matrix = np.ascontiguousarray(codes, dtype=np.int8)
+        else:
+            code_matrix = np.empty((0, EMBEDDING_DIM), dtype=np.int8)
+        self._set_rows(code_matrix, np.asarray(scales, dtype=np.float32), user_ids)
+        self._rebuild_index()
+
+    @staticmethod
+    async def _migrate_legacy(db, migrations: List[Tuple[str, str, str]]):
+        """Rewrite legacy ciphertexts, unless re-enrolled since they were read"""
+        try:
+            result = await db.users.bulk_write([
+                UpdateOne(
+                    {"_id": ObjectId(user_id), "face_embedding_encrypted": old},
+                    {"$set": {"face_embedding_encrypted": new}}
+                )
+                for user_id, old, new in migrations
+            ], ordered=False)
+            logger.info(f"Migrated {result.modified_count} legacy face embeddings")
+        except Exception as e:
+            logger.error(f"Legacy face embedding migration failed: {e}")
+
+    def _rebuild_index(self):
+        """Recreate the FAISS index from the quantized embedding matrix"""
+        if not FAISS_AVAILABLE:
+            self._index = None
+            return
+
+        vectors = self._dequantized()
+        n = len(self.user_ids)
+        if n >= IVFPQ_MIN_USERS:
+            nlist = int(4 * np.sqrt(n))
+            quantizer = faiss.IndexFlatL2(EMBEDDING_DIM)
+            index = faiss.IndexIVFPQ(quantizer, EMBEDDING_DIM, nlist, 16, 8)
+            index.train(vectors)
+            index.nprobe = 16
+        else:
+            index = faiss.IndexFlatL2(EMBEDDING_DIM)
+        # FAISS ids are matrix rows, so a single row can be replaced in place
+        index = faiss.IndexIDMap2(index)
+        index.add_with_ids(vectors, np.arange(n, dtype=np.int64))
+        self._index = index
+
+    def add(self, user_id: str, embedding: list):
+        """Add or replace the embedding of a single user"""
+        if self._adds_during_build is not None:
+            # Searchable now, and re-applied once the running build swaps rows
+            self._adds_during_build[user_id] = np.array(embedding, dtype=np.float32)
+        code, scale = quantize_embedding(embedding)
+
+        row = self._rows.get(user_id)
+        if row is not None:
+            # Re-enrollment: swap the row's vector instead of rebuilding
+            self._write_row(row, code, scale)
+            if self._index is not None:
+                row_ids = np.array([row], dtype=np.int64)
+                self._index.remove_ids(row_ids)
+                self._index.add_with_ids(self._dequantized(row, row + 1), row_ids)
+            return
+
+        self._append_row(user_id, code, scale)
+        row = len(self.user_ids) - 1
+        if self._index is not None and self._index.is_trained:
+            self._index.add_with_ids(
+                self._dequantized(row), np.array([row], dtype=np.int64)
+            )
+        else:
+            self._rebuild_index()
+
+    def search(self, embedding: list, threshold: float) -> Optional[str]:
+        """
+        Find the closest enrolled user
+
+        Args:
+            embedding: 128-dim face embedding to search for
+            threshold: Maximum Euclidean distance for a match
+
+        Returns:
+            User ID of the nearest embedding within threshold, None otherwise
+        """
+        if not self.user_ids:
+            return None
+
+        query = np.asarray(embedding, dtype=np.float32).reshape(1, EMBEDDING_DIM)
+
+        if self._index is not None:
+            distances, indices = self._index.search(query, 1)
+            best_dist_sq = float(distances[0, 0])
+            best_idx = int(indices[0, 0])
+            if best_idx < 0:
+                return None
+        else:
+            best_idx, best_dist_sq = self._scan(query[0], threshold)
+
+        if best_dist_sq < threshold ** 2:
+            return self.user_ids[best_idx]
+        return None
+
+    def _scan(self, q: np.ndarray, max_dist: float) -> Tuple[int, float]:
+        """
+        Exact nearest neighbour over the int8 rows within max_dist
+
+        Rows whose norm differs from the query's by max_dist or more cannot
+        be within max_dist (triangle inequality), so they are pruned from
+        the stored norms before touching their codes. For the rest,
+        ||s*c - q||^2 = ||s*c||^2 - 2 s (c.q) + ||q||^2 with precomputed row
+        norms; each block's candidates are dequantized once for one SGEMV.
+        Returns (-1, inf) when no row is within max_dist.
+        """
+        q_norm = float(np.sqrt(q @ q))
+
+        if face_kernels.NUMBA_AVAILABLE:
+            # Fused multi-threaded pass: no float32 block, no GEMV roundtrip
+            best_idx, best_dist_sq = face_kernels.nearest_q8_128(
+                self._codes, self._scales, self._norms_sq,
+                face_kernels.as_f32(q), np.float32(q_norm), np.float32(max_dist)
+            )
+            return int(best_idx), float(best_dist_sq)
+
+        best_idx, best_dist_sq = -1, np.inf
+        n = len(self.user_ids)
+
+        for start in range(0, n, SCAN_BLOCK_ROWS):
+            stop = min(start + SCAN_BLOCK_ROWS, n)
+            norms = np.sqrt(self._norms_sq[start:stop])
+            rows = start + np.flatnonzero(np.abs(norms - q_norm) < max_dist)
+            if rows.size == 0:
+                continue
+            dots = self._codes[rows].astype(np.float32) @ q
+            dists_sq = self._norms_sq[rows] - 2.0 * self._scales[rows] * dots
+            idx = int(dists_sq.argmin())
+            if dists_sq[idx] < best_dist_sq:
+                best_idx, best_dist_sq = int(rows[idx]), float(dists_sq[idx])
+
+        return best_idx, best_dist_sq + float(q @ q)
+
+
+# Global face index instance
+face_index = FaceIndex()
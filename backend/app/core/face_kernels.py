@@ -0,0 +1,126 @@
+"""
+Face Embedding Kernels
+
+Distance and similarity kernels for 128-dim embeddings: single pairs
+and the auto-login nearest-neighbour scan over the int8 index.
+For one pair, NumPy's per-call dispatch costs more than the arithmetic,
+so these are JIT-compiled with Numba when installed (multiple
+accumulators to break the loop-carried dependency). Without Numba they
+fall back to plain NumPy.
+"""
+
+import numpy as np
+
+# Import will be conditional based on availability
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+EMBEDDING_DIM = 128
+
+
+def as_f32(embedding) -> np.ndarray:
+    """Contiguous float32 view (or copy) of an embedding, as the kernels expect"""
+    return np.ascontiguousarray(embedding, dtype=np.float32)
+
+
+if NUMBA_AVAILABLE:
+
+    @njit("f4(f4[::1], f4[::1])", fastmath=True, cache=True)
+    def _l2sq_128(a, b):
+        # Four independent 8-lane accumulators over 32-float strides; with
+        # fastmath LLVM maps each lane block to one vector FMA (AVX2 or
+        # AVX-512, whichever the host CPU has since Numba targets it)
+        acc = np.zeros((4, 8), dtype=np.float32)
+        for i in range(0, 128, 32):
+            for k in range(4):
+                base = i + 8 * k
+                for j in range(8):
+                    d = a[base + j] - b[base + j]
+                    acc[k, j] += d * d
+        total = np.float32(0.0)
+        for j in range(8):
+            total += (acc[0, j] + acc[1, j]) + (acc[2, j] + acc[3, j])
+        return total
+
+    @njit("UniTuple(f4, 3)(f4[::1], f4[::1])", fastmath=True, cache=True)
+    def _dot_norms_128(a, b):
+        dot0 = np.float32(0.0)
+        dot1 = np.float32(0.0)
+        na = np.float32(0.0)
+        nb = np.float32(0.0)
+        for i in range(0, 128, 2):
+            dot0 += a[i] * b[i]
+            dot1 += a[i + 1] * b[i + 1]
+            na += a[i] * a[i] + a[i + 1] * a[i + 1]
+            nb += b[i] * b[i] + b[i + 1] * b[i + 1]
+        return dot0 + dot1, na, nb
+
+    @njit(
+        "Tuple((i8, f4))(i1[:, ::1], f4[::1], f4[::1], f4[::1], f4, f4)",
+        fastmath=True, parallel=True, cache=True
+    )
+    def nearest_q8_128(codes, scales, norms_sq, q, q_norm, max_dist):
+        """
+        Exact nearest row of an int8-quantized matrix to a float32 query
+
+        Rows whose norm differs from q_norm by max_dist or more are skipped
+        (they cannot be within max_dist). The rest are dequantized in
+        registers (scale * code) and diffed against the query in one pass;
+        rows are split across threads, then one argmin. Returns
+        (row, squared distance), (-1, inf) when no row qualifies.
+        """
+        n = codes.shape[0]
+        dists_sq = np.empty(n, dtype=np.float32)
+        for r in prange(n):
+            if abs(np.sqrt(norms_sq[r]) - q_norm) >= max_dist:
+                dists_sq[r] = np.inf
+                continue
+            s = scales[r]
+            acc = np.float32(0.0)
+            for j in range(128):
+                d = s * codes[r, j] - q[j]
+                acc += d * d
+            dists_sq[r] = acc
+
+        best_idx = -1
+        best_dist_sq = np.float32(np.inf)
+        for r in range(n):
+            if dists_sq[r] < best_dist_sq:
+                best_idx = r
+                best_dist_sq = dists_sq[r]
+        return best_idx, best_dist_sq
+
+else:
+
+    nearest_q8_128 = None
+
+    def _l2sq_128(a, b):
+        diff = a - b
+        return diff @ diff
+
+    def _dot_norms_128(a, b):
+        return a @ b, a @ a, b @ b
+
+
+def l2sq(a: np.ndarray, b: np.ndarray) -> float:
+    """Squared Euclidean distance between two float32 contiguous embeddings"""
+    if len(a) == EMBEDDING_DIM and len(b) == EMBEDDING_DIM:
+        return float(_l2sq_128(a, b))
+    diff = a - b
+    return float(diff @ diff)
+
+
+def cosine(a: np.ndarray, b: np.ndarray) -> float:
+    """Cosine similarity between two float32 contiguous embeddings (0 if either is zero)"""
+    if len(a) == EMBEDDING_DIM and len(b) == EMBEDDING_DIM:
+        dot, norm_a_sq, norm_b_sq = _dot_norms_128(a, b)
+    else:
+        dot, norm_a_sq, norm_b_sq = a @ b, a @ a, b @ b
+
+    norm_product = float(np.sqrt(norm_a_sq * norm_b_sq))
+    if norm_product == 0.0:
+        return 0.0
+    return float(dot) / norm_product
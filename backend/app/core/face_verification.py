@@ -8,10 +8,16 @@ IMPORTANT: Requires face_recognition library to be installed.
 See FACE_RECOGNITION_INSTALL.md for installation instructions.
 """
 
+import asyncio
+import time
 import numpy as np
+from collections import OrderedDict
 from typing import Optional, Tuple
+from bson import ObjectId
 from .security import encrypt_embedding, decrypt_embedding
 from .config import settings
+from .face_index import face_index
+from . import face_kernels
 
 # Import will be conditional based on availability
 try:
@@ -22,12 +28,28 @@ except ImportError:
     print("WARNING: face_recognition library not installed. Facial verification disabled.")
 
 
+# Euclidean distance threshold for a face match (dlib/face_recognition scale).
+# Comparisons use the squared form so the hot path needs no sqrt.
+FACE_DISTANCE_THRESHOLD = 0.55
+FACE_DISTANCE_THRESHOLD_SQ = FACE_DISTANCE_THRESHOLD ** 2
+
+
 def is_face_recognition_available() ->bool:
     """Check if face_recognition library is available"""
     return FACE_RECOGNITION_AVAILABLE
 
 
-def extract_face_embedding(image_array: np.ndarray) -> Optional[list]:
+def embedding_array(embedding) -> np.ndarray:
+    """
+    Convert a request embedding (JSON list) to the float32 array used downstream
+    
+    Call once at the HTTP boundary; the distance, validation and encryption
+    helpers then take the array as-is instead of re-boxing the list.
+    """
+    return face_kernels.as_f32(embedding)
+
+
+def extract_face_embedding(image_array: np.ndarray) -> Optional[np.ndarray]:
     """
     Extract 128-dimensional face embedding from image
     
@@ -35,7 +57,7 @@ def extract_face_embedding(image_array: np.ndarray) -> Optional[list]:
         image_array: numpy array of image (RGB format)
     
     Returns:
-        List of 128 floats or None if no face detected
+        float32 array of 128 values or None if no face detected
     """
     if not FACE_RECOGNITION_AVAILABLE:
         raise ImportError("face_recognition library not installed")
@@ -55,42 +77,100 @@ def extract_face_embedding(image_array: np.ndarray) -> Optional[list]:
     if len(face_encodings) == 0:
         return None
     
-    # Convert numpy array to list for storage
-    embedding = face_encodings[0].tolist()
-    return embedding
+    # Kept as an array; encrypt_embedding packs it directly for storage
+    return face_encodings[0].astype(np.float32)
 
 
-def cosine_similarity(embedding1: list, embedding2: list) -> float:
+def cosine_similarity(embedding1: np.ndarray, embedding2: np.ndarray) -> float:
     """
     Calculate cosine similarity between two face embeddings
     
     Args:
-        embedding1: First face embedding (128-dim list)
-        embedding2: Second face embedding (128-dim list)
+        embedding1: First face embedding (128-dim array)
+        embedding2: Second face embedding (128-dim array)
     
     Returns:
-        Similarity score between 0 and 1
+        Similarity score between -1 and 1
     """
-    # Convert to numpy arrays
-    vec1 = np.array(embedding1)
-    vec2 = np.array(embedding2)
+    return face_kernels.cosine(face_kernels.as_f32(embedding1), face_kernels.as_f32(embedding2))
+
+
+# Decrypted stored embeddings keyed by ciphertext: re-enrollment produces a
+# new ciphertext, so a stale entry is never hit and simply ages out
+EMBEDDING_CACHE_MAX_SIZE = 10_000
+_embedding_cache: "OrderedDict[str, Tuple[float, np.ndarray]]" = OrderedDict()
+
+
+def _lookup_cached_embedding(stored_embedding_encrypted: str) -> Optional[np.ndarray]:
+    """Return a cached embedding if present and not expired"""
+    entry = _embedding_cache.get(stored_embedding_encrypted)
+    if entry is None:
+        return None
     
-    # Calculate cosine similarity
-    dot_product = np.dot(vec1, vec2)
-    norm1 = np.linalg.norm(vec1)
-    norm2 = np.linalg.norm(vec2)
+    expires_at, embedding = entry
+    if time.monotonic() >= expires_at:
+        _embedding_cache.pop(stored_embedding_encrypted, None)
+        return None
     
-    if norm1 == 0 or norm2 == 0:
-        return 0.0
+    _embedding_cache.move_to_end(stored_embedding_encrypted)
+    return embedding
+
+
+def _store_cached_embedding(stored_embedding_encrypted: str, embedding: np.ndarray):
+    """Insert an embedding into the LRU/TTL cache"""
+    expires_at = time.monotonic() + settings.EMBEDDING_CACHE_TTL_SECONDS
+    _embedding_cache[stored_embedding_encrypted] = (expires_at, embedding)
+    _embedding_cache.move_to_end(stored_embedding_encrypted)
+    if len(_embedding_cache) > EMBEDDING_CACHE_MAX_SIZE:
+        _embedding_cache.popitem(last=False)
+
+
+def _decrypt_for_cache(stored_embedding_encrypted: str) -> np.ndarray:
+    """Decrypt a stored embedding into a read-only float16 array"""
+    embedding = np.asarray(
+        decrypt_embedding(stored_embedding_encrypted), dtype=np.float32
+    ).astype(np.float16)
+    embedding.flags.writeable = False
+    return embedding
+
+
+def get_cached_embedding(stored_embedding_encrypted: str) -> np.ndarray:
+    """
+    Decrypt a stored embedding once and cache it as a float16 array
+    
+    Keyed by the ciphertext itself, so re-enrollment (which produces a new
+    ciphertext) naturally bypasses the stale entry. Entries expire after
+    EMBEDDING_CACHE_TTL_SECONDS.
     
-    similarity = dot_product / (norm1 * norm2)
-    return float(similarity)
+    Args:
+        stored_embedding_encrypted: Encrypted stored embedding
+    
+    Returns:
+        Read-only float16 array of 128 values
+    """
+    embedding = _lookup_cached_embedding(stored_embedding_encrypted)
+    if embedding is None:
+        embedding = _decrypt_for_cache(stored_embedding_encrypted)
+        _store_cached_embedding(stored_embedding_encrypted, embedding)
+    return embedding
+
+
+async def get_cached_embedding_async(stored_embedding_encrypted: str) -> np.ndarray:
+    """Like get_cached_embedding, but decrypts cache misses on the default executor"""
+    embedding = _lookup_cached_embedding(stored_embedding_encrypted)
+    if embedding is None:
+        loop = asyncio.get_running_loop()
+        embedding = await loop.run_in_executor(
+            None, _decrypt_for_cache, stored_embedding_encrypted
+        )
+        _store_cached_embedding(stored_embedding_encrypted, embedding)
+    return embedding
 
 
 def verify_face_match(
-    live_embedding: list,
+    live_embedding: np.ndarray,
     stored_embedding_encrypted: str,
-    threshold: float = 0.55
+    threshold: float = FACE_DISTANCE_THRESHOLD
 ) -> Tuple[bool, float, str]:
     """
     Verify if live face matches stored face
@@ -103,20 +183,17 @@ def verify_face_match(
     Returns:
         Tuple of (is_match, similarity, verdict)
     """
-    # Decrypt stored embedding
+    # Decrypt stored embedding (cached per ciphertext)
     try:
-        stored_embedding = decrypt_embedding(stored_embedding_encrypted)
+        stored_embedding = get_cached_embedding(stored_embedding_encrypted)
     except Exception:
         # If decryption fails, return mismatch (fail safe)
         return False, 0.0, "DECRYPT_FAIL"
 
-    # Calculate Euclidean distance
-    vec1 = np.array(live_embedding)
-    vec2 = np.array(stored_embedding)
-    distance = float(np.linalg.norm(vec1 - vec2))
-    
-    # Check if distance is below threshold
-    is_match = distance < threshold
+    # Compare squared Euclidean distance against squared threshold
+    distance_sq = calculate_face_distance_sq(live_embedding, stored_embedding)
+    is_match = distance_sq < threshold * threshold
+    distance = float(np.sqrt(distance_sq))
 
     # Convert distance to a rough similarity score (0..1)
     similarity = max(0.0, min(1.0, 1.0 - distance))
@@ -125,7 +202,23 @@ def verify_face_match(
     return is_match, similarity, verdict
 
 
-def calculate_face_distance(embedding1: list, embedding2: list) -> float:
+def calculate_face_distance_sq(embedding1: np.ndarray, embedding2: np.ndarray) -> float:
+    """
+    Calculate squared Euclidean distance between two face embeddings
+    
+    Compare against FACE_DISTANCE_THRESHOLD_SQ to avoid the sqrt.
+    
+    Args:
+        embedding1: First 128-dim face embedding
+        embedding2: Second 128-dim face embedding
+    
+    Returns:
+        Squared Euclidean distance (lower = more similar)
+    """
+    return face_kernels.l2sq(face_kernels.as_f32(embedding1), face_kernels.as_f32(embedding2))
+
+
+def calculate_face_distance(embedding1: np.ndarray, embedding2: np.ndarray) -> float:
     """
     Calculate Euclidean distance between two face embeddings
     
@@ -136,13 +229,14 @@ def calculate_face_distance(embedding1: list, embedding2: list) -> float:
     Returns:
         Euclidean distance (lower = more similar)
     """
-    vec1 = np.array(embedding1)
-    vec2 = np.array(embedding2)
-    distance = float(np.linalg.norm(vec1 - vec2))
-    return distance
+    return float(np.sqrt(calculate_face_distance_sq(embedding1, embedding2)))
 
 
-async def find_user_by_face(db, input_embedding: list) -> Optional[dict]:
+async def find_user_by_face(
+    db,
+    input_embedding: np.ndarray,
+    projection: Optional[dict] = None
+) -> Optional[dict]:
     """
     Search database for user with matching face
     Used for face-based auto-login
@@ -150,79 +244,67 @@ async def find_user_by_face(db, input_embedding: list) -> Optional[dict]:
     Args:
         db: Database instance
         input_embedding: Face embedding to search for
+        projection: Fields to load for the matched user (all if None)
     
     Returns:
         User document if match found, None otherwise
     """
-    # Get all users with face embeddings
-    users_cursor = db.users.find({"face_embedding_encrypted": {"$exists": True}})
-    users = await users_cursor.to_list(length=None) 
-    
-    best_match = None
-    best_similarity = 0.0
-    
-    for user in users:
-        try:
-            stored_embedding_encrypted = user.get("face_embedding_encrypted")
-            if not stored_embedding_encrypted:
-                continue
-            
-            # Decrypt and compare
-            stored_embedding = decrypt_embedding(stored_embedding_encrypted)
-            
-            # Use Euclidean Distance ONLY (Standard for dlib/face_recognition)
-            # Threshold: 0.6 is typical, 0.5 is strict.
-            # We use 0.55 for a balance of security and usability.
-            
-            vec1 = np.array(input_embedding)
-            vec2 = np.array(stored_embedding)
-            dist = np.linalg.norm(vec1 - vec2)
-            
-            # Check strict threshold
-            if dist < 0.55:
-                # Lower distance is better
-                if best_match is None or dist < best_similarity:
-                    best_similarity = dist
-                    best_match = user
-                    
-        except Exception as e:
-            continue
-    
-    return best_match
-
-
-def validate_embedding_quality(embedding: list) -> Tuple[bool, str]:
+    # Decrypts every enrolled embedding, so only once per process
+    await face_index.ensure_built(db)
+    
+    # Use Euclidean Distance ONLY (Standard for dlib/face_recognition)
+    # Threshold: 0.6 is typical, 0.5 is strict.
+    # We use 0.55 for a balance of security and usability.
+    user_id = face_index.search(input_embedding, threshold=FACE_DISTANCE_THRESHOLD)
+    if user_id is None:
+        return None
+    
+    return await db.users.find_one({"_id": ObjectId(user_id)}, projection=projection)
+
+
+def validate_embedding_quality(embedding) -> Tuple[bool, str]:
     """
     Validate that face embedding is of sufficient quality
     
     Args:
-        embedding: Face embedding to validate
+        embedding: Face embedding to validate (float32 array, or list)
     
     Returns:
         Tuple of (is_valid, error_message)
     """
-    if not embedding:
+    if embedding is None:
         return False, "No embedding provided"
     
-    if not isinstance(embedding, list):
+    if not isinstance(embedding, (list, np.ndarray)):
         return False, "Embedding must be a list"
     
+    if len(embedding) == 0:
+        return False, "No embedding provided"
+    
     if len(embedding) != 128:
         return False, f"Embedding must be 128-dimensional, got {len(embedding)}"
     
-    # Check for all zeros (failed extraction)
-    if all(x == 0 for x in embedding):
-        return False, "Embedding is all zeros - invalid face data"
+    # No copy for float32 arrays
+    vec = np.asarray(embedding, dtype=np.float32)
+    if vec.shape != (128,):
+        return False, f"Embedding must be a flat vector, got shape {vec.shape}"
+    
+    # One reduction covers both checks: NaN/Inf propagate into the sum and
+    # only an all-zero vector sums to 0 (float64 so large values can't overflow)
+    magnitude = float(np.abs(vec).sum(dtype=np.float64))
     
     # Check for reasonable value ranges
-    embedding_array = np.array(embedding)
-    if np.any(np.isnan(embedding_array)) or np.any(np.isinf(embedding_array)):
+    if not np.isfinite(magnitude):
         return False, "Embedding contains invalid values"
     
+    # Check for all zeros (failed extraction)
+    if magnitude == 0.0:
+        return False, "Embedding is all zeros - invalid face data"
+    
     return True, "Valid"
 
 
 # Mock function for when face_recognition is not installed
-def mock_extract_embedding() -> list:
+def mock_extract_embedding() -> np.ndarray:
     """Generate a mock embedding for testing without face_recognition"""
-    return list(np.random.randn(128))
+    return np.random.randn(128).astype(np.float32)
@@ -6,9 +6,11 @@ Used in facial CAPTCHA system for production-grade security.
 """
 
 import random
+import secrets
+import time
 from enum import Enum
-from typing import Dict, Optional
-from datetime import datetime
+from typing import Dict, Optional, Tuple
+from datetime import datetime, timedelta
 
 
 class ChallengeType(str, Enum):
@@ -31,6 +33,9 @@ CHALLENGE_INSTRUCTIONS = {
     ChallengeType.FOLLOW_DOT: "Follow the Moving Dot with Your Eyes"
 }
 
+# Materialized once; random.choice needs a sequence
+_CHALLENGE_TYPES = tuple(ChallengeType)
+
 
 def generate_challenge() -> Dict:
     """
@@ -43,17 +48,20 @@ def generate_challenge() -> Dict:
         - time_limit: Time limit in seconds
         - challenge_id: Unique ID for this challenge
     """
-    challenge_type = random.choice(list(ChallengeType))
+    challenge_type = random.choice(_CHALLENGE_TYPES)
     time_limit = random.randint(5, 8)  # 5-8 seconds per challenge
     
-    challenge_id = f"{challenge_type.value}_{int(datetime.utcnow().timestamp() * 1000)}"
+    # One clock read for both fields; the random suffix keeps IDs unique
+    # when several challenges are issued within the same tick
+    ts_ns = time.time_ns()
+    challenge_id = f"{challenge_type.value}_{ts_ns}_{secrets.token_hex(4)}"
     
     return {
         "challenge_id": challenge_id,
         "challenge_type": challenge_type.value,
         "instruction": CHALLENGE_INSTRUCTIONS[challenge_type],
         "time_limit": time_limit,
-        "generated_at": datetime.utcnow().isoformat()
+        "generated_at": datetime.utcfromtimestamp(ts_ns / 1e9).isoformat()
     }
 
 
@@ -216,8 +224,6 @@ async def get_recent_failures(db, user_id: str, window_minutes: int = 10) -> int
     Returns:
         Number of failed attempts in the time window
     """
-    from datetime import timedelta
-    
     cutoff_time = datetime.utcnow() - timedelta(minutes=window_minutes)
     
     count = await db.facial_captcha_history.count_documents({
@@ -227,3 +233,64 @@ async def get_recent_failures(db, user_id: str, window_minutes: int = 10) -> int
     })
     
     return count
+
+
+async def get_challenge_validation_and_failures(
+    db,
+    user_id: str,
+    challenge_id: str,
+    window_minutes: int = 10
+) -> Tuple[bool, int]:
+    """
+    Check challenge replay and count recent failures in a single round trip
+    
+    Combines validate_challenge_history and get_recent_failures into one
+    $facet aggregation over the user's attempt history.
+    
+    Args:
+        db: Database instance
+        user_id: User identifier
+        challenge_id: Challenge ID to check
+        window_minutes: Time window for counting failures
+    
+    Returns:
+        Tuple of (is_valid_challenge, recent_failures)
+    """
+    cutoff_time = datetime.utcnow() - timedelta(minutes=window_minutes)
+    
+    # Replay check covers the whole history, only the failure count is windowed.
+    # $facet sub-pipelines can't use indexes, so the leading $match narrows to
+    # exactly the documents either facet needs; each $or branch is served by
+    # one of the (user_id, challenge_id) / (user_id, timestamp) indexes.
+    pipeline = [
+        {
+            "$match": {
+                "user_id": user_id,
+                "$or": [
+                    {"challenge_id": challenge_id},
+                    {"timestamp": {"$gte": cutoff_time}, "success": False}
+                ]
+            }
+        },
+        {
+            "$facet": {
+                "used": [
+                    {"$match": {"challenge_id": challenge_id}},
+                    {"$limit": 1},
+                    {"$project": {"_id": 1}}
+                ],
+                "failures": [
+                    {"$match": {"success": False, "timestamp": {"$gte": cutoff_time}}},
+                    {"$count": "n"}
+                ]
+            }
+        }
+    ]
+    
+    result = await db.facial_captcha_history.aggregate(pipeline).to_list(length=1)
+    facets = result[0] if result else {}
+    
+    is_valid_challenge = not facets.get("used")
+    failures = facets.get("failures") or [{"n": 0}]
+    
+    return is_valid_challenge, failures[0]["n"]
@@ -0,0 +1,96 @@
+"""
+Rolling-Window Rate Limiting
+
+Sliding-window counters stored in Redis sorted sets. Trimming, counting and
+recording run in a single Lua script so the check is atomic across workers.
+Without Redis, check_and_record returns None and callers fall back to their
+in-process or MongoDB based limits.
+"""
+
+import itertools
+import logging
+import os
+import time
+from typing import Optional, Tuple
+
+from .redis_client import RedisClient
+
+logger = logging.getLogger(__name__)
+
+# KEYS[1] = sorted set, ARGV = now (ms), window (ms), limit, record flag, member
+ROLLING_WINDOW_SCRIPT = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+
+redis.call('ZREMRANGEBYSCORE', key, '-inf', '(' .. (now - window))
+local count = redis.call('ZCARD', key)
+
+if count >= limit then
+    return {0, count}
+end
+
+if ARGV[4] == '1' then
+    redis.call('ZADD', key, now, ARGV[5])
+    redis.call('PEXPIRE', key, window)
+    count = count + 1
+end
+return {1, count}
+"""
+
+# Script object caches the SHA from SCRIPT LOAD and calls EVALSHA
+_script = None
+_script_client = None
+
+# Unique sorted-set members for attempts recorded in the same millisecond
+_member_seq = itertools.count()
+_member_prefix = str(os.getpid())
+
+
+def _get_script(client):
+    """Register the rolling-window script once per Redis client"""
+    global _script, _script_client
+    if _script is None or _script_client is not client:
+        _script = client.register_script(ROLLING_WINDOW_SCRIPT)
+        _script_client = client
+    return _script
+
+
+async def check_and_record(
+    identifier: str,
+    kind: str,
+    limit: int,
+    window_s: int,
+    record: bool = True
+) -> Optional[Tuple[bool, int]]:
+    """
+    Check a rolling-window limit and optionally record an event
+
+    Args:
+        identifier: Subject of the limit (user ID, username, IP)
+        kind: Limit namespace, e.g. "login" or "captcha_fail"
+        limit: Maximum events allowed within the window
+        window_s: Window length in seconds
+        record: Record this event if still under the limit
+
+    Returns:
+        Tuple of (allowed, count within window), or None without Redis
+    """
+    client = RedisClient.get_client()
+    if client is None:
+        return None
+
+    now_ms = int(time.time() * 1000)
+    member = f"{now_ms}:{_member_prefix}:{next(_member_seq)}"
+
+    try:
+        allowed, count = await _get_script(client)(
+            keys=[f"rl:{kind}:{identifier}"],
+            args=[now_ms, window_s * 1000, limit, "1" if record else "0", member]
+        )
+    except Exception as e:
+        logger.error(f"Redis rate limit check failed, falling back: {e}")
+        return None
+
+    return bool(allowed), int(count)
@@ -0,0 +1,56 @@
+from .config import settings
+import logging
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Import will be conditional based on availability
+try:
+    import redis.asyncio as aioredis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+
+class RedisClient:
+    """Optional Redis connection manager for state shared across workers"""
+
+    client = None
+
+    @classmethod
+    async def connect_redis(cls):
+        """Connect to Redis if REDIS_URL is configured"""
+        if not settings.REDIS_URL:
+            logger.info("REDIS_URL not set, using in-process state")
+            return
+
+        if not REDIS_AVAILABLE:
+            logger.warning("REDIS_URL set but redis package not installed, using in-process state")
+            return
+
+        try:
+            cls.client = aioredis.from_url(
+                settings.REDIS_URL,
+                max_connections=settings.REDIS_MAX_CONNECTIONS
+            )
+            await cls.client.ping()
+            # Host and port only: the URL may carry a password
+            url = urlsplit(settings.REDIS_URL)
+            where = f"{url.hostname}:{url.port or 6379}" if url.hostname else url.path
+            logger.info(f"Connected to Redis at {where}")
+        except Exception as e:
+            logger.error(f"Failed to connect to Redis, using in-process state: {e}")
+            cls.client = None
+
+    @classmethod
+    async def close_redis(cls):
+        """Close Redis connection pool"""
+        if cls.client:
+            await cls.client.aclose()
+            cls.client = None
+            logger.info("Closed Redis connection")
+
+    @classmethod
+    def get_client(cls):
+        """Get Redis client, or None when running without Redis"""
+        return cls.client
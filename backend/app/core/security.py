@@ -1,42 +1,152 @@
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
-from typing import Optional, Dict
+from typing import Optional, Dict, Tuple
 from .config import settings
 import hashlib
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, InvalidToken
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.backends import default_backend
 import base64
+import binascii
+import json
+from collections import OrderedDict
+from functools import lru_cache
 
+import os
+import time
+import struct
+import numpy as np
+import asyncio
+import logging
 import bcrypt
+from concurrent.futures import ThreadPoolExecutor
+from argon2 import PasswordHasher, extract_parameters
+from argon2.exceptions import VerifyMismatchError, VerificationError, InvalidHashError
+
+logger = logging.getLogger(__name__)
+
+# Argon2id hasher (C backend). time_cost is pinned in config so every worker
+# hashes with the same parameters; measure it offline with
+# calibrate_password_hasher() (python -m app.core.security [target_ms]).
+password_hasher = PasswordHasher(
+    time_cost=settings.ARGON2_TIME_COST, memory_cost=64 * 1024, parallelism=4
+)
+
+# Password hashing is CPU-bound; argon2/bcrypt release the GIL, so run them
+# on a dedicated pool to keep the event loop responsive
+_pw_pool = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="pwhash")
+
+
+def calibrate_password_hasher(target_ms: int) -> int:
+    """
+    Smallest Argon2 time_cost (from the configured one) whose hash takes at least target_ms
+    
+    Offline tool for choosing ARGON2_TIME_COST on the deployment hardware;
+    it does not change the running hasher.
+    """
+    time_cost = password_hasher.time_cost
+    while True:
+        candidate = PasswordHasher(
+            time_cost=time_cost,
+            memory_cost=password_hasher.memory_cost,
+            parallelism=password_hasher.parallelism
+        )
+        start = time.perf_counter()
+        candidate.hash("calibration-password")
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if elapsed_ms >= target_ms or time_cost >= 20:
+            break
+        time_cost += 1
+    
+    logger.info(f"Argon2 calibrated: time_cost={time_cost} ({elapsed_ms:.0f} ms per hash)")
+    return time_cost
+
+
+def _is_bcrypt_hash(hashed_password: str) -> bool:
+    """Legacy hashes were produced by bcrypt ($2a$/$2b$/$2y$ prefix)"""
+    return hashed_password.startswith("$2")
+
 
 def hash_password(password: str) -> str:
-    """Hash password using bcrypt with proper 72-byte handling"""
-    # Truncate password to 72 bytes for bcrypt
-    password_bytes = password.encode('utf-8')[:72]
-    # Generate salt and hash
-    salt = bcrypt.gensalt()
-    hashed = bcrypt.hashpw(password_bytes, salt)
-    return hashed.decode('utf-8')
+    """Hash password using Argon2id"""
+    return password_hasher.hash(password)
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """Verify password against hash"""
-    password_bytes = plain_password.encode('utf-8')[:72]
-    return bcrypt.checkpw(password_bytes, hashed_password.encode('utf-8'))
+    """Verify password against hash (Argon2id, or legacy bcrypt)"""
+    if _is_bcrypt_hash(hashed_password):
+        password_bytes = plain_password.encode('utf-8')[:72]
+        return bcrypt.checkpw(password_bytes, hashed_password.encode('utf-8'))
+    
+    try:
+        return password_hasher.verify(hashed_password, plain_password)
+    except (VerifyMismatchError, VerificationError, InvalidHashError):
+        return False
+
+
+async def hash_password_async(password: str) -> str:
+    """Hash password on the password thread pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pw_pool, hash_password, password)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """Verify password on the password thread pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pw_pool, verify_password, plain_password, hashed_password)
+
+
+def password_needs_rehash(hashed_password: str) -> bool:
+    """
+    Check if hash is legacy bcrypt or weaker than the current Argon2 parameters
+    
+    Only lower costs count as outdated, so a hash made with stronger
+    parameters (e.g. before ARGON2_TIME_COST was lowered) isn't rewritten
+    on every login.
+    """
+    if _is_bcrypt_hash(hashed_password):
+        return True
+    try:
+        params = extract_parameters(hashed_password)
+    except InvalidHashError:
+        return True
+    return (
+        params.time_cost < password_hasher.time_cost
+        or params.memory_cost < password_hasher.memory_cost
+    )
+
 
+def build_token_snapshot(user: Dict, session: Optional[Dict]) -> Dict:
+    """Build the short-lived user/session state snapshot embedded in access tokens"""
+    session = session or {}
+    return {
+        "bal": user.get("balance", 0.0),
+        "acct": user.get("account_no", ""),
+        "ts": session.get("threat_score", 0),
+        "lk": session.get("is_locked", False),
+        "cap": session.get("requires_facial_captcha", False)
+    }
 
-def create_access_token(data: Dict, expires_delta: Optional[timedelta] = None) -> str:
-    """Create JWT access token"""
+
+def create_access_token(
+    data: Dict,
+    expires_delta: Optional[timedelta] = None,
+    snapshot: Optional[Dict] = None
+) -> str:
+    """Create JWT access token, optionally carrying a state snapshot"""
     to_encode = data.copy()
+    now = datetime.utcnow()
     if expires_delta:
-        expire = datetime.utcnow() + expires_delta
+        expire = now + expires_delta
     else:
-        expire = datetime.utcnow() + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
+        expire = now + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
     
-    to_encode.update({"exp": expire, "type": "access"})
+    to_encode.update({"exp": expire, "iat": now, "type": "access"})
+    if snapshot is not None:
+        to_encode["snap"] = snapshot
     encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
     return encoded_jwt
 
@@ -50,13 +160,43 @@ def create_refresh_token(data: Dict) -> str:
     return encoded_jwt
 
 
+# Decoded JWT payloads keyed by token string. An entry never outlives the
+# token's own exp claim; invalid tokens are not cached.
+TOKEN_CACHE_MAX_SIZE = 50_000
+TOKEN_CACHE_TTL_SECONDS = 60
+_token_cache: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+
+
 def decode_token(token: str) -> Optional[Dict]:
-    """Decode and validate JWT token"""
+    """Decode and validate JWT token (cached, callers must not mutate the result)"""
+    now = time.time()
+    entry = _token_cache.get(token)
+    if entry is not None:
+        if now < entry[0]:
+            _token_cache.move_to_end(token)
+            return entry[1]
+        _token_cache.pop(token, None)
+    
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
-        return payload
     except JWTError:
         return None
+    
+    expires_at = now + TOKEN_CACHE_TTL_SECONDS
+    exp = payload.get("exp")
+    if isinstance(exp, (int, float)):
+        expires_at = min(expires_at, exp)
+    
+    _token_cache[token] = (expires_at, payload)
+    if len(_token_cache) > TOKEN_CACHE_MAX_SIZE:
+        _token_cache.popitem(last=False)
+    
+    return payload
+
+
+def invalidate_token(token: str):
+    """Drop a token from the decode cache (e.g. on logout)"""
+    _token_cache.pop(token, None)
 
 
 def generate_device_fingerprint(user_agent: str, ip: str) -> str:
@@ -66,38 +206,159 @@ def generate_device_fingerprint(user_agent: str, ip: str) -> str:
 
 
 # AES-256 Encryption for face embeddings
-def get_cipher():
-    """Get Fernet cipher for AES encryption"""
-    # Derive a proper key from the settings key
+@lru_cache(maxsize=4)
+def _derive_cipher(secret: str) -> Fernet:
+    """
+    Fernet cipher for a server-side secret
+    
+    A secret that already is a Fernet key (urlsafe base64 of 32 random bytes)
+    is used as-is; anything else goes through one-shot HKDF-SHA256. The
+    secret is a high-entropy config value, so a slow password KDF buys nothing.
+    """
+    try:
+        if len(base64.urlsafe_b64decode(secret.encode())) == 32:
+            return Fernet(secret.encode())
+    except (binascii.Error, ValueError):
+        pass
+    
+    hkdf = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=b'intellisecure_bank_salt',
+        info=b'fernet-key',
+        backend=default_backend()
+    )
+    key = base64.urlsafe_b64encode(hkdf.derive(secret.encode()))
+    return Fernet(key)
+
+
+@lru_cache(maxsize=4)
+def _derive_legacy_cipher(secret: str) -> Fernet:
+    """PBKDF2-derived cipher that older ciphertexts were written with (decrypt only)"""
     kdf = PBKDF2HMAC(
         algorithm=hashes.SHA256(),
         length=32,
-        salt=b'intellisecure_bank_salt',  # In production, use unique salt per user
-        iterations=10000,  # Reduced from 100000 for better performance
+        salt=b'intellisecure_bank_salt',
+        iterations=10000,
         backend=default_backend()
     )
-    key = base64.urlsafe_b64encode(kdf.derive(settings.AES_ENCRYPTION_KEY.encode()))
+    key = base64.urlsafe_b64encode(kdf.derive(secret.encode()))
     return Fernet(key)
 
 
-def encrypt_embedding(embedding: list) -> str:
-    """Encrypt face embedding vector"""
+def get_cipher():
+    """Get Fernet cipher for AES encryption"""
+    # Derive a proper key from the settings key (cached after first use)
+    return _derive_cipher(settings.AES_ENCRYPTION_KEY)
+
+
+def _decrypt_any_key(encrypted_bytes: bytes) -> Tuple[bytes, bool]:
+    """Decrypt with the current key, falling back to the legacy PBKDF2 key"""
+    try:
+        return get_cipher().decrypt(encrypted_bytes), False
+    except InvalidToken:
+        legacy_cipher = _derive_legacy_cipher(settings.AES_ENCRYPTION_KEY)
+        return legacy_cipher.decrypt(encrypted_bytes), True
+
+
+# Quantized embedding plaintext: magic, float32 scale, then int8 values.
+# Legacy ciphertexts hold a stringified float list instead.
+EMBEDDING_Q8_MAGIC = b"Q8"
+_SCALE_FORMAT = "<f"
+_SCALE_SIZE = struct.calcsize(_SCALE_FORMAT)
+
+
+def quantize_embedding(embedding) -> Tuple[np.ndarray, float]:
+    """
+    Quantize an embedding to int8 with a per-vector scale
+    
+    Embeddings are not normalized (face matching uses raw Euclidean
+    distance), so each vector keeps its own scale = max(|x|) / 127.
+    
+    Returns:
+        Tuple of (int8 values, scale)
+    """
+    vec = np.asarray(embedding, dtype=np.float32)
+    max_abs = float(np.abs(vec).max()) if vec.size else 0.0
+    scale = max_abs / 127.0 if max_abs > 0 else 1.0
+    quantized = np.clip(np.round(vec / scale), -127, 127).astype(np.int8)
+    return quantized, scale
+
+
+def dequantize_embedding(quantized: np.ndarray, scale: float) -> np.ndarray:
+    """Expand int8 values back to a float32 embedding"""
+    return quantized.astype(np.float32) * np.float32(scale)
+
+
+def pack_quantized_embedding(embedding) -> bytes:
+    """Serialize an embedding as scale (float32 LE) followed by int8 values"""
+    quantized, scale = quantize_embedding(embedding)
+    return struct.pack(_SCALE_FORMAT, scale) + quantized.tobytes()
+
+
+def unpack_quantized_embedding(data: bytes) -> np.ndarray:
+    """Deserialize pack_quantized_embedding output into a float32 embedding"""
+    if len(data) <= _SCALE_SIZE:
+        raise ValueError("Quantized embedding too short")
+    (scale,) = struct.unpack_from(_SCALE_FORMAT, data)
+    quantized = np.frombuffer(data, dtype=np.int8, offset=_SCALE_SIZE)
+    return dequantize_embedding(quantized, scale)
+
+
+def encrypt_embedding(embedding) -> str:
+    """Encrypt face embedding vector (stored int8-quantized, 134 bytes)"""
     cipher = get_cipher()
-    # Convert list to string for encryption
-    embedding_str = str(embedding)
-    encrypted = cipher.encrypt(embedding_str.encode())
+    plaintext = EMBEDDING_Q8_MAGIC + pack_quantized_embedding(embedding)
+    encrypted = cipher.encrypt(plaintext)
     return base64.b64encode(encrypted).decode()
 
 
-def decrypt_embedding(encrypted_embedding: str) -> list:
-    """Decrypt face embedding vector"""
-    cipher = get_cipher()
+def decrypt_embedding_versioned(encrypted_embedding: str) -> Tuple[np.ndarray, bool]:
+    """
+    Decrypt face embedding vector and report whether it is legacy
+    
+    Legacy means written with the old PBKDF2-derived key or in the old
+    stringified-list format; either way it should be re-encrypted.
+    
+    Returns:
+        Tuple of (float32 embedding, is_legacy)
+    """
     encrypted_bytes = base64.b64decode(encrypted_embedding.encode())
-    decrypted = cipher.decrypt(encrypted_bytes)
-    # Convert string back to list
-    return eval(decrypted.decode())
+    decrypted, legacy_key = _decrypt_any_key(encrypted_bytes)
+    
+    if decrypted.startswith(EMBEDDING_Q8_MAGIC):
+        return unpack_quantized_embedding(decrypted[len(EMBEDDING_Q8_MAGIC):]), legacy_key
+    
+    # Legacy format: stringified list of floats, parsed as data (never eval'd)
+    if not decrypted.startswith(b"["):
+        raise ValueError("Unrecognized embedding format")
+    return np.asarray(json.loads(decrypted), dtype=np.float32), True
+
+
+def decrypt_embedding(encrypted_embedding: str) -> np.ndarray:
+    """Decrypt face embedding vector (float32 array)"""
+    return decrypt_embedding_versioned(encrypted_embedding)[0]
+
+
+async def encrypt_embedding_async(embedding: list) -> str:
+    """Encrypt face embedding on the default executor (keeps KDF/AES off the event loop)"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, encrypt_embedding, embedding)
+
+
+async def decrypt_embedding_async(encrypted_embedding: str) -> np.ndarray:
+    """Decrypt face embedding on the default executor (keeps KDF/AES off the event loop)"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, decrypt_embedding, encrypted_embedding)
 
 
 # Alias for backward compatibility
 decrypt_face_embedding = decrypt_embedding
 encrypt_face_embedding = encrypt_embedding
+
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    target_ms = int(sys.argv[1]) if len(sys.argv) > 1 else 250
+    print(f"ARGON2_TIME_COST={calibrate_password_hasher(target_ms)}")
@@ -5,12 +5,136 @@ Deterministic, explainable threat scoring for continuous authentication.
 Production-grade implementation with transparent logic.
 """
 
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple, Union
 from datetime import datetime
 from .config import settings
+from .face_verification import calculate_face_distance_sq, FACE_DISTANCE_THRESHOLD_SQ
+from functools import lru_cache
 import ipaddress
 
 
+def _ipv4_to_int(ip: str) -> int:
+    """Dotted-quad IPv4 to a 32-bit integer (ValueError if not IPv4)"""
+    octets = ip.split(".")
+    if len(octets) != 4:
+        raise ValueError(ip)
+    value = 0
+    for octet in octets:
+        if not octet.isdigit():
+            raise ValueError(ip)
+        n = int(octet)
+        if n > 255:
+            raise ValueError(ip)
+        value = (value << 8) | n
+    return value
+
+
+@lru_cache(maxsize=8192)
+def _parse_iso_timestamp(value: str) -> datetime:
+    """Parse an ISO 8601 timestamp (cached: a session's created_at never changes)"""
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+@lru_cache(maxsize=1024)
+def _ip_drift_score(session_ip: str, current_ip: str) -> float:
+    """Score two differing IPs: same /24 -> 10, otherwise 25"""
+    # IPv4 (the common case): /24 match is one XOR and shift
+    try:
+        if (_ipv4_to_int(session_ip) ^ _ipv4_to_int(current_ip)) >> 8 == 0:
+            return 10  # Same subnet, minor concern
+        return 25  # Different subnet, medium concern
+    except ValueError:
+        pass
+    
+    try:
+        # Parse IPs
+        current_ip_obj = ipaddress.ip_address(current_ip)
+        session_network = ipaddress.ip_network(f"{session_ip}/24", strict=False)
+        
+        if current_ip_obj in session_network:
+            return 10
+        return 25
+    except ValueError:
+        return 25  # Invalid IP, treat as different
+
+
+# Weights for the components scored inline in calculate_threat_score
+CAPTCHA_FAILURE_WEIGHT = 45  # per failed facial CAPTCHA
+ML_ANOMALY_WEIGHT = 20  # scales the 0-1 model score
+ML_TRIGGER_FLOOR = 5  # weighted ML score must exceed this to report a trigger
+MAX_THREAT_SCORE = 100
+
+# Camera anomaly bits (_score_signals)
+CAMERA_MULTIPLE_FACES = 1
+CAMERA_NO_FACE = 2
+CAMERA_BLOCKED = 4
+
+# Camera trigger labels in reporting order
+_CAMERA_TRIGGERS = (
+    (CAMERA_MULTIPLE_FACES, "Multiple faces detected"),
+    (CAMERA_NO_FACE, "No face detected"),
+    (CAMERA_BLOCKED, "Camera blocked or covered")
+)
+
+# (breakdown key, trigger label, component must exceed) in reporting
+# order; the camera label is None because it expands from the bitmask
+_TRIGGER_RULES = (
+    ("device_mismatch", "Device mismatch detected", 0),
+    ("ip_drift", "IP address change detected", 0),
+    ("camera_anomalies", None, 0),
+    ("behavioral_anomalies", "Unusual behavioral patterns", 0),
+    ("facial_captcha_failure", "Facial CAPTCHA verification failed", 0),
+    ("ml_anomaly", "ML model detected anomaly", ML_TRIGGER_FLOOR),
+    ("face_mismatch", "Live face does not match database", 0),
+    ("mouse_behavior", "Bot-like mouse behavior detected", 0)
+)
+
+
+def _score_signals(signals: Dict) -> Tuple[float, int, float, float]:
+    """
+    Camera, behavioral and mouse scores in one pass over the signals
+    
+    The only place these rules live; each signal is read once per heartbeat.
+    
+    Returns:
+        Tuple of (camera score, camera anomaly bits, behavior score, mouse score)
+    """
+    get = signals.get
+    
+    # Camera anomalies (capped at 35)
+    camera_score = 0
+    camera_flags = 0
+    if get("multiple_faces"):
+        camera_score += 20
+        camera_flags |= CAMERA_MULTIPLE_FACES
+    if get("camera_blocked"):  # Camera blocked/covered
+        camera_score += 15
+        camera_flags |= CAMERA_BLOCKED
+    if get("face_present") == False:  # No face present when expected
+        camera_score += 15
+        camera_flags |= CAMERA_NO_FACE
+    
+    # Keystroke/mouse timing anomalies, > 2 standard deviations (capped at 20)
+    behavior_score = 0
+    if get("keystroke_deviation", 0) > 2.0:
+        behavior_score += 10
+    if get("mouse_deviation", 0) > 2.0:
+        behavior_score += 10
+    
+    # Bot-like mouse behavior (capped at 25): low Shannon entropy of movement
+    # vectors = repetitive/scripted, low velocity variance = constant speed
+    mouse_score = 0
+    mouse_entropy = get("mouse_entropy", 1.0)
+    if mouse_entropy < 0.3:  # Very low entropy = bot
+        mouse_score += 15
+    elif mouse_entropy < 0.5:  # Moderately low = suspicious
+        mouse_score += 8
+    if get("mouse_velocity_variance", 1.0) < 0.2:  # Too consistent = bot
+        mouse_score += 10
+    
+    return min(camera_score, 35), camera_flags, min(behavior_score, 20), min(mouse_score, 25)
+
+
 class ThreatEngine:
     """Rule-based threat scoring with explainable logic"""
     
@@ -35,87 +159,55 @@ class ThreatEngine:
             - triggers: List of triggered rules
             - recommended_action: Suggested action
         """
-        score = 0
-        breakdown = {}
-        triggers = []
-        
-        # 1. Device Mismatch Detection (High Weight: +40)
-        device_score = ThreatEngine._check_device_mismatch(
-            session_data.get("device_fingerprint"),
-            current_signals.get("device_fingerprint")
-        )
-        if device_score > 0:
-            triggers.append("Device mismatch detected")
-        breakdown["device_mismatch"] = device_score
-        score += device_score
-        
-        # 2. IP Drift Detection (Medium Weight: +25)
-        ip_score = ThreatEngine._check_ip_drift(
-            session_data.get("ip_address"),
-            current_signals.get("ip_address")
-        )
-        if ip_score > 0:
-            triggers.append("IP address change detected")
-        breakdown["ip_drift"] =ip_score
-        score += ip_score
-        
-        # 3. Camera Anomaly Detection (High Weight: +35)
-        camera_score = ThreatEngine._check_camera_anomalies(current_signals)
-        if camera_score > 0:
-            if current_signals.get("multiple_faces"):
-                triggers.append("Multiple faces detected")
-            if current_signals.get("face_present") == False:
-                triggers.append("No face detected")
-            if current_signals.get("camera_blocked"):
-                triggers.append("Camera blocked or covered")
-        breakdown["camera_anomalies"] = camera_score
-        score += camera_score
-        
-        # 4. Behavioral Anomaly (Medium Weight: +20)
-        behavior_score = ThreatEngine._check_behavioral_anomalies(current_signals)
-        if behavior_score > 0:
-            triggers.append("Unusual behavioral patterns")
-        breakdown["behavioral_anomalies"] = behavior_score
-        score += behavior_score
-        
-        # 5. Facial CAPTCHA Failure (High Weight: +45)
-        captcha_fail_score = current_signals.get("facial_captcha_failed", 0) * 45
-        if captcha_fail_score > 0:
-            triggers.append("Facial CAPTCHA verification failed")
-        breakdown["facial_captcha_failure"] = captcha_fail_score
-        score += captcha_fail_score
-        
-        # 6. ML Anomaly Score (Medium Weight: +20)
-        ml_score = ml_anomaly_score * 20
-        if ml_score > 5:
-            triggers.append("ML model detected anomaly")
-        breakdown["ml_anomaly"] = ml_score
-        score += ml_score
+        camera_score, camera_flags, behavior_score, mouse_score = _score_signals(current_signals)
         
-        # 7. Face Mismatch Detection (Critical Weight: +50)
-        face_mismatch_score = ThreatEngine._check_face_mismatch(
-            current_signals.get("live_face_embedding"),
-            session_data.get("stored_face_embedding")
-        )
-        if face_mismatch_score > 0:
-            triggers.append("Live face does not match database")
-        breakdown["face_mismatch"] = face_mismatch_score
-        score += face_mismatch_score
-        
-        # 8. Mouse Behavior Analysis (Medium Weight: +25)
-        mouse_behavior_score = ThreatEngine._check_mouse_behavior(current_signals)
-        if mouse_behavior_score > 0:
-            triggers.append("Bot-like mouse behavior detected")
-        breakdown["mouse_behavior"] = mouse_behavior_score
-        score += mouse_behavior_score
+        # Component scores in breakdown order (weights are applied inside
+        # each check, so the total is a plain sum)
+        breakdown = {
+            # 1. Device Mismatch Detection (High Weight: +40)
+            "device_mismatch": ThreatEngine._check_device_mismatch(
+                session_data.get("device_fingerprint"),
+                current_signals.get("device_fingerprint")
+            ),
+            # 2. IP Drift Detection (Medium Weight: +25)
+            "ip_drift": ThreatEngine._check_ip_drift(
+                session_data.get("ip_address"),
+                current_signals.get("ip_address")
+            ),
+            # 3. Camera Anomaly Detection (High Weight: +35)
+            "camera_anomalies": camera_score,
+            # 4. Behavioral Anomaly (Medium Weight: +20)
+            "behavioral_anomalies": behavior_score,
+            # 5. Facial CAPTCHA Failure (High Weight: +45)
+            "facial_captcha_failure": current_signals.get("facial_captcha_failed", 0) * CAPTCHA_FAILURE_WEIGHT,
+            # 6. ML Anomaly Score (Medium Weight: +20)
+            "ml_anomaly": ml_anomaly_score * ML_ANOMALY_WEIGHT,
+            # 7. Face Mismatch Detection (Critical Weight: +50)
+            "face_mismatch": ThreatEngine._check_face_mismatch(
+                current_signals.get("live_face_embedding"),
+                session_data.get("stored_face_embedding")
+            ),
+            # 8. Mouse Behavior Analysis (Medium Weight: +25)
+            "mouse_behavior": mouse_score,
+            # 9. Session Age Factor (minor adjustment, no trigger)
+            "session_age": ThreatEngine._check_session_age(session_data.get("created_at"))
+        }
+        score = sum(breakdown.values())
         
-        # 9. Session Age Factor (minor adjustment)
-        age_score = ThreatEngine._check_session_age(session_data.get("created_at"))
-        breakdown["session_age"] = age_score
-        score += age_score
+        triggers = []
+        for key, label, floor in _TRIGGER_RULES:
+            if breakdown[key] > floor:
+                if label is None:
+                    # Camera: one trigger per anomaly that fired
+                    triggers.extend(
+                        camera_label for bit, camera_label in _CAMERA_TRIGGERS
+                        if camera_flags & bit
+                    )
+                else:
+                    triggers.append(label)
         
         # Cap score at 100
-        score = min(score, 100)
+        score = min(score, MAX_THREAT_SCORE)
         
         # Determine recommended action
         recommended_action = ThreatEngine._get_recommended_action(score)
@@ -150,65 +242,24 @@ class ThreatEngine:
         if session_ip == current_ip:
             return 0
         
-        try:
-            # Parse IPs
-            session_ip_obj = ipaddress.ip_address(session_ip)
-            current_ip_obj = ipaddress.ip_address(current_ip)
-            
-            # Check if in same /24 subnet (more tolerant)
-            session_network = ipaddress.ip_network(f"{session_ip}/24", strict=False)
-            
-            if current_ip_obj in session_network:
-                return 10  # Same subnet, minor concern
-            else:
-                return 25  # Different subnet, medium concern
-        except:
-            return 25  # Invalid IP, treat as different
-    
-    @staticmethod
-    def _check_camera_anomalies(signals: Dict) -> float:
-        """Check for camera-related anomalies"""
-        score = 0
-        
-        # Multiple faces detected
-        if signals.get("multiple_faces"):
-            score += 20
-        
-        # Camera blocked/covered
-        if signals.get("camera_blocked"):
-            score += 15
-        
-        # No face present when expected
-        if signals.get("face_present") == False:
-            score += 15
-        
-        return min(score, 35)  # Cap at 35
+        return _ip_drift_score(session_ip, current_ip)
     
     @staticmethod
-    def _check_behavioral_anomalies(signals: Dict) -> float:
-        """Check for unusual behavioral patterns"""
-        score = 0
-        
-        # Keystroke timing anomalies
-        keystroke_deviation = signals.get("keystroke_deviation", 0)
-        if keystroke_deviation > 2.0:  # 2 standard deviations
-            score += 10
-        
-        # Mouse movement anomalies
-        mouse_deviation = signals.get("mouse_deviation", 0)
-        if mouse_deviation > 2.0:
-            score += 10
+    def _check_session_age(created_at: Union[datetime, str, None]) -> float:
+        """
+        Check session age (minor factor)
         
-        return min(score, 20)  # Cap at 20
-    
-    @staticmethod
-    def _check_session_age(created_at: Optional[str]) -> float:
-        """Check session age (minor factor)"""
+        Sessions store created_at as a BSON date; ISO strings from older
+        sessions are still accepted.
+        """
         if not created_at:
             return 0
         
         try:
-            created_time = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
+            if isinstance(created_at, datetime):
+                created_time = created_at
+            else:
+                created_time = _parse_iso_timestamp(created_at)
             age_hours = (datetime.utcnow() - created_time).total_seconds() / 3600
             
             # Very old sessions get minor penalty
@@ -239,20 +290,17 @@ class ThreatEngine:
         Check if live face matches stored database face
         Uses same strict Euclidean distance as login (< 0.55)
         """
-        if not live_embedding or not stored_embedding:
-            return 0  # Can't verify without embeddings
+        if live_embedding is None or stored_embedding is None:
+            return 0  # Can't verify without embeddings (may be ndarrays)
         
         if len(live_embedding) != 128 or len(stored_embedding) != 128:
             return 0  # Invalid embeddings
         
         try:
-            import numpy as np
-            vec1 = np.array(live_embedding)
-            vec2 = np.array(stored_embedding)
-            distance = np.linalg.norm(vec1 - vec2)
+            distance_sq = calculate_face_distance_sq(live_embedding, stored_embedding)
             
-            # Same threshold as login verification (0.55)
-            if distance >= 0.55:
+            # Same threshold as login verification (0.55), compared squared
+            if distance_sq >= FACE_DISTANCE_THRESHOLD_SQ:
                 # Face doesn't match - CRITICAL THREAT
                 return 50
             return 0
@@ -260,29 +308,6 @@ class ThreatEngine:
             print(f"Face mismatch check error: {e}")
             return 0
     
-    @staticmethod
-    def _check_mouse_behavior(signals: Dict) -> float:
-        """
-        Detect bot-like mouse behavior
-        Low entropy = repetitive/scripted movements
-        Low variance = constant speed (not human)
-        """
-        score = 0
-        
-        # Check mouse entropy (Shannon entropy of movement vectors)
-        mouse_entropy = signals.get("mouse_entropy", 1.0)
-        if mouse_entropy < 0.3:  # Very low entropy = bot
-            score += 15
-        elif mouse_entropy < 0.5:  # Moderately low = suspicious
-            score += 8
-        
-        # Check velocity variance
-        velocity_variance = signals.get("mouse_velocity_variance", 1.0)
-        if velocity_variance < 0.2:  # Too consistent = bot
-            score += 10
-        
-        return min(score, 25)  # Cap at 25
-    
     @staticmethod
     def should_trigger_facial_captcha(score: float) -> bool:
         """Check if facial CAPTCHA should be triggered"""
@@ -2,116 +2,397 @@
 WebSocket Manager
 
 Manages WebSocket connections for real-time updates.
+
+With Redis configured, personal messages and broadcasts are published on a
+pub/sub bus and every worker delivers them to the sockets it holds, so a
+message reaches a user regardless of which worker accepted their socket.
+Without Redis, delivery is in-process.
 """
 
-from typing import Dict, List
+from typing import Dict, List, Optional, Set, Tuple, Union
 from fastapi import WebSocket
-import json
+import asyncio
+import orjson
 import logging
+import struct
+
+from ..core.config import settings
 
 logger = logging.getLogger(__name__)
 
 
+def encode_message(message: dict) -> str:
+    """Serialize a WebSocket message with orjson (numpy scalars/arrays allowed)"""
+    return orjson.dumps(message, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+
+def _json_str(value: str) -> str:
+    """JSON string literal for splicing into the fixed-shape event frames"""
+    return orjson.dumps(value).decode()
+
+
+# Binary threat update frame: opcode, score, flags, trigger count, then one
+# byte per trigger id. Decoded by frontend/src/utils/websocket.js.
+OP_THREAT_UPDATE = 1
+_THREAT_UPDATE_HEADER = struct.Struct("<BfBB")
+THREAT_FLAG_REQUIRES_CAPTCHA = 1
+
+# Wire ids of threat triggers are their positions here: append only, and
+# keep in sync with THREAT_TRIGGERS in the frontend
+THREAT_TRIGGERS = (
+    "Device mismatch detected",
+    "IP address change detected",
+    "Multiple faces detected",
+    "No face detected",
+    "Camera blocked or covered",
+    "Unusual behavioral patterns",
+    "Facial CAPTCHA verification failed",
+    "ML model detected anomaly",
+    "Live face does not match database",
+    "Bot-like mouse behavior detected"
+)
+_TRIGGER_IDS = {label: trigger_id for trigger_id, label in enumerate(THREAT_TRIGGERS)}
+UNKNOWN_TRIGGER_ID = 255
+
+
+def trigger_ids(triggers: List[str]) -> List[int]:
+    """Wire ids for threat trigger labels (the frontend maps them back)"""
+    return [_TRIGGER_IDS.get(trigger, UNKNOWN_TRIGGER_ID) for trigger in triggers]
+
+
+def encode_threat_update(score: float, triggers: List[str], requires_facial_captcha: bool) -> bytes:
+    """Pack a threat update into a binary frame (~8 bytes instead of ~80+ of JSON)"""
+    ids = bytes(trigger_ids(triggers[:255]))
+    flags = THREAT_FLAG_REQUIRES_CAPTCHA if requires_facial_captcha else 0
+    return _THREAT_UPDATE_HEADER.pack(OP_THREAT_UPDATE, score, flags, len(ids)) + ids
+
+
+# Pub/sub channels: one per user with sockets on this worker, one for broadcasts
+USER_CHANNEL_PREFIX = "ws:user:"
+BROADCAST_CHANNEL = "ws:broadcast"
+
+# Bus frames carry a one-byte kind so text and binary frames survive the trip
+_BUS_TEXT = b"T"
+_BUS_BINARY = b"B"
+
+
+# Per-connection outbound queue bound; the oldest message is dropped when a
+# client falls this far behind
+OUTBOUND_QUEUE_SIZE = 256
+
+# Queued messages merged into one JSON-array frame by a connection's writer
+MAX_MERGED_MESSAGES = 32
+
+
 class WebSocketManager:
     """Manage WebSocket connections for real-time communication"""
     
     def __init__(self):
-        # Store active connections: {user_id: [websocket1, websocket2, ...]}
-        self.active_connections: Dict[str, List[WebSocket]] = {}
+        # Parallel per-connection lists (slot i = one socket); each socket is
+        # written only by its own writer task, fed by its queue
+        self._sockets: List[WebSocket] = []
+        self._user_ids: List[str] = []
+        self._queues: List[asyncio.Queue] = []
+        self._writers: List[asyncio.Task] = []
+        # socket -> slot, and user_id -> slots of that user's sockets
+        self._slots: Dict[WebSocket, int] = {}
+        self._by_user: Dict[str, Set[int]] = {}
+        # (socket, user_id) whose writer failed, removed after the next delivery
+        self._dead: List[Tuple[WebSocket, str]] = []
+        # Redis pub/sub bus (None: deliver in-process only)
+        self._redis = None
+        self._pubsub = None
+        self._listener: Optional[asyncio.Task] = None
+    
+    async def start_bus(self, redis_client):
+        """Start cross-worker delivery over Redis pub/sub (no-op without Redis)"""
+        if redis_client is None:
+            return
+        self._redis = redis_client
+        self._pubsub = redis_client.pubsub()
+        await self._pubsub.subscribe(BROADCAST_CHANNEL)
+        # Users whose sockets connected before the bus started
+        for user_id in self._by_user:
+            await self._pubsub.subscribe(USER_CHANNEL_PREFIX + user_id)
+        self._listener = asyncio.create_task(self._listen())
+        logger.info("WebSocket pub/sub bus started")
+    
+    async def stop_bus(self):
+        """Stop the pub/sub listener and release its connection"""
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+            self._pubsub = None
+        self._redis = None
+    
+    async def _listen(self):
+        """Deliver bus messages to the sockets held by this worker"""
+        prefix = USER_CHANNEL_PREFIX.encode()
+        while True:
+            try:
+                async for message in self._pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    data = message["data"]
+                    payload = data[1:] if data[:1] == _BUS_BINARY else data[1:].decode()
+                    channel = message["channel"]
+                    if channel.startswith(prefix):
+                        self._deliver_local(channel[len(prefix):].decode(), payload)
+                    else:
+                        self._broadcast_local(payload)
+                    if self._dead:
+                        await self._reap_dead()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"WebSocket pub/sub listener error: {e}")
+                await asyncio.sleep(1)
+    
+    async def _publish(self, channel: str, payload: Union[str, bytes]) -> bool:
+        """Publish a frame on the bus; False when there is no bus or it failed"""
+        if self._redis is None:
+            return False
+        if isinstance(payload, bytes):
+            frame = _BUS_BINARY + payload
+        else:
+            frame = _BUS_TEXT + payload.encode()
+        try:
+            await self._redis.publish(channel, frame)
+            return True
+        except Exception as e:
+            logger.error(f"WebSocket publish to {channel} failed, delivering locally: {e}")
+            return False
     
     async def connect(self, websocket: WebSocket, user_id: str):
         """Accept WebSocket connection for user"""
         await websocket.accept()
         
-        if user_id not in self.active_connections:
-            self.active_connections[user_id] = []
-        
-        self.active_connections[user_id].append(websocket)
+        queue = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+        slot = len(self._sockets)
+        self._sockets.append(websocket)
+        self._user_ids.append(user_id)
+        self._queues.append(queue)
+        self._writers.append(asyncio.create_task(self._writer(websocket, queue, user_id)))
+        self._slots[websocket] = slot
+        first_for_user = user_id not in self._by_user
+        self._by_user.setdefault(user_id, set()).add(slot)
+        if first_for_user and self._pubsub is not None:
+            try:
+                await self._pubsub.subscribe(USER_CHANNEL_PREFIX + user_id)
+            except Exception as e:
+                logger.error(f"Failed to subscribe WebSocket channel for {user_id}: {e}")
         logger.info(f"WebSocket connected for user: {user_id}")
     
-    def disconnect(self, websocket: WebSocket, user_id: str):
+    async def disconnect(self, websocket: WebSocket, user_id: str):
         """Remove WebSocket connection"""
-        if user_id in self.active_connections:
-            if websocket in self.active_connections[user_id]:
-                self.active_connections[user_id].remove(websocket)
+        slot = self._slots.pop(websocket, None)
+        if slot is not None:
+            self._writers[slot].cancel()
             
+            user_slots = self._by_user[user_id]
+            user_slots.discard(slot)
             # Clean up if no more connections
-            if not self.active_connections[user_id]:
-                del self.active_connections[user_id]
+            if not user_slots:
+                del self._by_user[user_id]
+                if self._pubsub is not None:
+                    try:
+                        await self._pubsub.unsubscribe(USER_CHANNEL_PREFIX + user_id)
+                    except Exception as e:
+                        logger.error(f"Failed to unsubscribe WebSocket channel for {user_id}: {e}")
+            
+            # Swap-pop: move the last slot into the freed one
+            last = len(self._sockets) - 1
+            if slot != last:
+                moved_socket = self._sockets[last]
+                moved_user_slots = self._by_user[self._user_ids[last]]
+                moved_user_slots.discard(last)
+                moved_user_slots.add(slot)
+                self._slots[moved_socket] = slot
+                self._sockets[slot] = moved_socket
+                self._user_ids[slot] = self._user_ids[last]
+                self._queues[slot] = self._queues[last]
+                self._writers[slot] = self._writers[last]
+            self._sockets.pop()
+            self._user_ids.pop()
+            self._queues.pop()
+            self._writers.pop()
         
         logger.info(f"WebSocket disconnected for user: {user_id}")
     
+    async def _writer(self, websocket: WebSocket, queue: asyncio.Queue, user_id: str):
+        """
+        Sole sender for one socket
+        
+        When several JSON messages are waiting they go out as one JSON-array
+        frame (the frontend unpacks arrays); binary frames are sent as-is.
+        
+        Frames go straight to the ASGI send callable: the socket is already
+        accepted and this task is its only sender, so Starlette's per-call
+        state checks in send_text/send_bytes have nothing to catch.
+        """
+        send = websocket._send
+        try:
+            pending = None
+            while True:
+                payload = pending if pending is not None else await queue.get()
+                pending = None
+                if isinstance(payload, bytes):
+                    await send({"type": "websocket.send", "bytes": payload})
+                    continue
+                
+                if not queue.empty():
+                    batch = [payload]
+                    while len(batch) < MAX_MERGED_MESSAGES and not queue.empty():
+                        queued = queue.get_nowait()
+                        if isinstance(queued, bytes):
+                            # Keep ordering: send the merged text frame first
+                            pending = queued
+                            break
+                        batch.append(queued)
+                    if len(batch) > 1:
+                        payload = "[" + ",".join(batch) + "]"
+                await send({"type": "websocket.send", "text": payload})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Socket is gone: stop queueing for it at the next delivery rather
+            # than waiting for the endpoint's receive loop to notice
+            logger.error(f"Error sending message to {user_id}: {e}")
+            self._dead.append((websocket, user_id))
+    
+    @staticmethod
+    def _enqueue(queue: asyncio.Queue, payload: Union[str, bytes]):
+        """Queue a serialized message, dropping the oldest if the queue is full"""
+        if queue.full():
+            queue.get_nowait()
+            logger.warning("WebSocket outbound queue full, dropping oldest message")
+        queue.put_nowait(payload)
+    
+    async def _reap_dead(self):
+        """Remove every socket whose writer has failed, in one pass"""
+        dead, self._dead = self._dead, []
+        for websocket, user_id in dead:
+            await self.disconnect(websocket, user_id)
+    
+    def send_to_connection(self, websocket: WebSocket, message: dict):
+        """Queue a message for one specific socket"""
+        self.send_prepared_to_connection(websocket, encode_message(message))
+    
+    def send_prepared_to_connection(self, websocket: WebSocket, payload: str):
+        """Queue an already-serialized JSON message for one specific socket"""
+        slot = self._slots.get(websocket)
+        if slot is not None:
+            self._enqueue(self._queues[slot], payload)
+    
+    def _deliver_local(self, user_id: str, payload: Union[str, bytes]):
+        """Queue a frame for this worker's sockets of one user"""
+        for slot in self._by_user.get(user_id, ()):
+            self._enqueue(self._queues[slot], payload)
+    
+    def _broadcast_local(self, payload: Union[str, bytes]):
+        """Queue a frame for every socket on this worker"""
+        for queue in self._queues:
+            self._enqueue(queue, payload)
+    
+    async def _send_to_user(self, user_id: str, payload: Union[str, bytes]):
+        """Route a frame to a user's sockets on whichever workers hold them"""
+        if not await self._publish(USER_CHANNEL_PREFIX + user_id, payload):
+            self._deliver_local(user_id, payload)
+        if self._dead:
+            await self._reap_dead()
+    
     async def send_personal_message(self, user_id: str, message: dict):
         """Send message to all connections of a specific user"""
-        if user_id in self.active_connections:
-            for connection in self.active_connections[user_id]:
-                try:
-                    await connection.send_json(message)
-                except Exception as e:
-                    logger.error(f"Error sending message to {user_id}: {e}")
+        if not self._has_recipients(user_id):
+            return
+        # Serialized once for all of the user's sockets
+        await self._send_to_user(user_id, encode_message(message))
     
     async def broadcast(self, message: dict):
         """Broadcast message to all connected clients"""
-        for user_id, connections in self.active_connections.items():
-            for connection in connections:
-                try:
-                    await connection.send_json(message)
-                except Exception as e:
-                    logger.error(f"Error broadcasting to {user_id}: {e}")
-    
-    async def send_threat_update(self, user_id: str, threat_score: float, triggers: List[str]):
-        """Send threat score update"""
-        message = {
-            "event": "threat:update",
-            "data": {
-                "threat_score": threat_score,
-                "triggers": triggers
-            }
-        }
-        await self.send_personal_message(user_id, message)
+        await self.broadcast_prepared(encode_message(message))
+    
+    async def broadcast_prepared(self, payload: Union[str, bytes]):
+        """
+        Broadcast an already-serialized JSON message to all connected clients
+        
+        Bytes (e.g. straight from Redis pub/sub) are decoded once; clients
+        still receive text frames, which the frontend JSON.parses.
+        """
+        if isinstance(payload, bytes):
+            payload = payload.decode()
+        
+        if not await self._publish(BROADCAST_CHANNEL, payload):
+            self._broadcast_local(payload)
+        if self._dead:
+            await self._reap_dead()
+    
+    async def send_threat_update(self, user_id: str, threat_result: dict, requires_facial_captcha: bool):
+        """
+        Send threat score update
+        
+        Binary frame when WS_BINARY_THREAT_UPDATES is on (score, triggers and
+        the CAPTCHA flag are all the frontend reads), otherwise the JSON
+        threat_update message; both carry triggers as ids, not labels.
+        """
+        if not self._has_recipients(user_id):
+            return
+        
+        if settings.WS_BINARY_THREAT_UPDATES:
+            payload = encode_threat_update(
+                threat_result["score"], threat_result["triggers"], requires_facial_captcha
+            )
+        else:
+            data = {key: value for key, value in threat_result.items() if key != "triggers"}
+            data["trigger_ids"] = trigger_ids(threat_result["triggers"])
+            data["requires_facial_captcha"] = requires_facial_captcha
+            payload = encode_message({"type": "threat_update", "data": data})
+        await self._send_to_user(user_id, payload)
+    
+    def _has_recipients(self, user_id: str) -> bool:
+        """False when delivery is in-process only and the user has no socket here"""
+        return self._redis is not None or user_id in self._by_user
     
     async def send_session_lock(self, user_id: str, reason: str):
         """Notify user of session lock"""
-        message = {
-            "event": "session:lock",
-            "data": {
-                "reason": reason,
-                "requires_facial_captcha": True
-            }
-        }
-        await self.send_personal_message(user_id, message)
+        if self._has_recipients(user_id):
+            await self._send_to_user(
+                user_id,
+                f'{{"event":"session:lock","data":{{"reason":{_json_str(reason)},'
+                f'"requires_facial_captcha":true}}}}'
+            )
     
     async def send_security_alert(self, user_id: str, alert_type: str, message_text: str):
         """Send security alert"""
-        message = {
-            "event": "security:alert",
-            "data": {
-                "type": alert_type,
-                "message": message_text
-            }
-        }
-        await self.send_personal_message(user_id, message)
+        if self._has_recipients(user_id):
+            await self._send_to_user(
+                user_id,
+                f'{{"event":"security:alert","data":{{"type":{_json_str(alert_type)},'
+                f'"message":{_json_str(message_text)}}}}}'
+            )
     
     async def send_face_verification_result(self, user_id: str, success: bool, verdict: str):
         """Send face verification result"""
-        event = "security:face_verified" if success else "security:face_failed"
-        message = {
-            "event": event,
-            "data": {
-                "verdict": verdict
-            }
-        }
-        await self.send_personal_message(user_id, message)
+        if self._has_recipients(user_id):
+            event = "security:face_verified" if success else "security:face_failed"
+            await self._send_to_user(
+                user_id,
+                f'{{"event":"{event}","data":{{"verdict":{_json_str(verdict)}}}}}'
+            )
     
     async def send_camera_warning(self, user_id: str, warning: str):
         """Send camera anomaly warning"""
-        message = {
-            "event": "camera:warning",
-            "data": {
-                "warning": warning
-            }
-        }
-        await self.send_personal_message(user_id, message)
+        if self._has_recipients(user_id):
+            await self._send_to_user(
+                user_id,
+                f'{{"event":"camera:warning","data":{{"warning":{_json_str(warning)}}}}}'
+            )
 
 
 # Global WebSocket manager instance
@@ -1,36 +1,9 @@
-import requests
-import sys
+import asyncio
+import httpx
 
 BASE_URL = "http://localhost:8000"
 
-def test_endpoint(method, path, data=None):
-    url = f"{BASE_URL}{path}"
-    try:
-        if method == "GET":
-            response = requests.get(url)
-        else:
-            response = requests.post(url, json=data)
-        
-        print(f"{method} {path} -> {response.status_code}")
-        # print(response.text[:100])
-        return response.status_code
-    except Exception as e:
-        print(f"Failed to connect to {url}: {e}")
-        return None
-
-print("Checking API endpoints...")
-
-# 1. Check if server is up
-test_endpoint("GET", "/")
-
-# 2. Check Admin routes (known to work)
-test_endpoint("GET", "/api/admin/notification")
-
-# 3. Check Monitoring Ping (new)
-test_endpoint("GET", "/api/monitoring/ping")
-
-# 4. Check Monitoring Heartbeat (problematic)
-test_endpoint("POST", "/api/monitoring/heartbeat", {
+HEARTBEAT = {
     "signals": {
         "device_fingerprint": "test",
         "ip_address": "127.0.0.1",
@@ -43,7 +16,44 @@ test_endpoint("POST", "/api/monitoring/heartbeat", {
         "mouse_entropy": 0,
         "mouse_velocity_variance": 0
     }
-})
+}
+
+CHECKS = [
+    # 1. Check if server is up
+    ("GET", "/", None),
+    # 2. Check Admin routes (known to work)
+    ("GET", "/api/admin/notification", None),
+    # 3. Check Monitoring Ping (new)
+    ("GET", "/api/monitoring/ping", None),
+    # 4. Check Monitoring Heartbeat (problematic)
+    ("POST", "/api/monitoring/heartbeat", HEARTBEAT),
+    # 5. Check Face Verification (Auth required, expect 401)
+    ("POST", "/api/face-verification/check", {"live_embedding": []}),
+]
+
+
+async def test_endpoint(client, method, path, data=None):
+    try:
+        if method == "GET":
+            response = await client.get(path)
+        else:
+            response = await client.post(path, json=data)
+        return f"{method} {path} -> {response.status_code}"
+    except Exception as e:
+        return f"Failed to connect to {BASE_URL}{path}: {e}"
+
+
+async def main():
+    print("Checking API endpoints...")
+    # One pooled keep-alive client, all checks in flight at once
+    async with httpx.AsyncClient(base_url=BASE_URL) as client:
+        results = await asyncio.gather(
+            *(test_endpoint(client, method, path, data) for method, path, data in CHECKS)
+        )
+    # Printed in check order regardless of completion order
+    for line in results:
+        print(line)
+
 
-# 5. Check Face Verification (Auth required, expect 401)
-test_endpoint("POST", "/api/face-verification/check", {"live_embedding": []})
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,19 +1,48 @@
-import urllib.request
+import hashlib
 import os
+import shutil
+
+import requests
 
 url = "https://github.com/z-mahmud22/Dlib_Windows_Python3.x/raw/main/dlib-19.24.1-cp311-cp311-win_amd64.whl"
 filename = "dlib-19.24.1-cp311-cp311-win_amd64.whl"
+expected_sha256 = "6f1a5ee167975d7952b28e0ce4495f1d9a77644761cf5720fb66d7c6188ae496"
+
+CHUNK_SIZE = 1 << 20  # 1 MiB
+
+
+def sha256_of(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+if os.path.exists(filename) and sha256_of(filename) == expected_sha256:
+    print(f"{filename} already downloaded (SHA256 verified), skipping")
+    raise SystemExit(0)
 
 print(f"Downloading {filename} from {url}...")
 
+partial = filename + ".part"
 try:
-    urllib.request.urlretrieve(url, filename)
-    
-    if os.path.exists(filename):
+    # A wheel is already a zip: ask for it uncompressed and stream it to disk
+    with requests.get(url, stream=True, headers={"Accept-Encoding": "identity"}, timeout=30) as response:
+        response.raise_for_status()
+        with open(partial, "wb") as f:
+            shutil.copyfileobj(response.raw, f, length=CHUNK_SIZE)
+
+    actual_sha256 = sha256_of(partial)
+    if actual_sha256 != expected_sha256:
+        os.remove(partial)
+        print(f"Download failed: SHA256 mismatch (got {actual_sha256})")
+    else:
+        os.replace(partial, filename)
         print(f"Successfully downloaded {filename}")
         print(f"File size: {os.path.getsize(filename)} bytes")
-    else:
-        print("Download failed: File not found after download attempt.")
 
 except Exception as e:
+    if os.path.exists(partial):
+        os.remove(partial)
     print(f"Error downloading file: {e}")
@@ -6,13 +6,18 @@ Production-grade AI-powered banking platform with continuous authentication.
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from contextlib import asynccontextmanager
+import asyncio
 import logging
 
 from app.core.config import settings
 from app.core.database import Database
+from app.core.redis_client import RedisClient
+from app.core.face_index import face_index
+from app.core.behavioral_writer import behavioral_writer
 from app.api import auth, facial_captcha, monitoring, banking, admin, face_verification
-from app.sockets.websocket_manager import websocket_manager
+from app.sockets.websocket_manager import websocket_manager, encode_message
 from app.core.security import decode_token
 
 # Configure logging
@@ -23,18 +28,38 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+async def rebuild_face_index_periodically():
+    """Periodically rebuild the face index to pick up changes from other workers"""
+    while True:
+        await asyncio.sleep(settings.FACE_INDEX_REBUILD_INTERVAL)
+        try:
+            await face_index.build(Database.get_db())
+        except Exception as e:
+            logger.error(f"Face index rebuild failed: {e}")
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifecycle manager for startup and shutdown"""
     # Startup
     logger.info("Starting IntelliSecure Bank backend...")
     await Database.connect_db()
+    app.state.mongo = Database.client
     logger.info("Connected to MongoDB")
+    await RedisClient.connect_redis()
+    await websocket_manager.start_bus(RedisClient.get_client())
+    await face_index.build(Database.get_db())
+    face_index_task = asyncio.create_task(rebuild_face_index_periodically())
+    behavioral_writer.start(Database.get_db())
     
     yield
     
     # Shutdown
     logger.info("Shutting down IntelliSecure Bank backend...")
+    face_index_task.cancel()
+    await behavioral_writer.stop()
+    await websocket_manager.stop_bus()
+    await RedisClient.close_redis()
     await Database.close_db()
     logger.info("Database connections closed")
 
@@ -44,7 +69,8 @@ app = FastAPI(
     title="IntelliSecure Bank API",
     description="Production-grade AI-powered banking platform with continuous authentication",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # Configure CORS - Hardcoded for development
@@ -95,30 +121,36 @@ async def health_check():
     return {"status": "healthy"}
 
 
+# Constant frames, encoded once (text: the frontend JSON.parses them)
+_WELCOME_FRAME = encode_message({
+    "event": "connected",
+    "message": "WebSocket connected successfully"
+})
+_PONG_FRAME = encode_message({"type": "pong"})
+
+
 @app.websocket("/ws/{token}")
 async def websocket_endpoint(websocket: WebSocket, token: str):
     """
     WebSocket endpoint for real-time updates
     Authenticate via token in URL
     """
-    # Decode token to get user
+    # Decode token to get user (decode_token caches validated tokens until
+    # expiry, so reconnect storms don't redo the HMAC check)
     payload = decode_token(token)
     
-    if not payload:
+    if not payload or payload.get("type") != "access" or "sub" not in payload:
         await websocket.close(code=1008, reason="Invalid token")
         return
     
-    user_id = payload.get("sub")
+    user_id = payload["sub"]
     
     try:
         # Connect WebSocket
         await websocket_manager.connect(websocket, user_id)
         
         # Send welcome message
-        await websocket.send_json({
-            "event": "connected",
-            "message": "WebSocket connected successfully"
-        })
+        websocket_manager.send_prepared_to_connection(websocket, _WELCOME_FRAME)
         
         # Keep connection alive and listen for messages
         while True:
@@ -128,7 +160,7 @@ async def websocket_endpoint(websocket: WebSocket, token: str):
                 
                 # Echo back or process as needed
                 if data.get("type") == "ping":
-                    await websocket.send_json({"type": "pong"})
+                    websocket_manager.send_prepared_to_connection(websocket, _PONG_FRAME)
                 
             except WebSocketDisconnect:
                 break
@@ -138,15 +170,31 @@ async def websocket_endpoint(websocket: WebSocket, token: str):
     
     finally:
         # Cleanup
-        websocket_manager.disconnect(websocket, user_id)
+        await websocket_manager.disconnect(websocket, user_id)
 
 
 if __name__ == "__main__":
+    import sys
     import uvicorn
+    
+    workers = max(1, settings.UVICORN_WORKERS)
+    if workers > 1 and not settings.REDIS_URL:
+        logger.warning(
+            "UVICORN_WORKERS=%d without REDIS_URL: WebSocket messages only reach "
+            "sockets on the worker that sends them", workers
+        )
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=8000,
-        reload=True,
-        log_level="info"
+        # Auto-reload is for development and can't run multiple workers
+        reload=workers == 1,
+        workers=workers,
+        log_level="info",
+        # uvloop is not available on Windows
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        # Frames are small JSON/binary updates; per-connection deflate would
+        # recompress every broadcast once per socket for little gain
+        ws_per_message_deflate=False
     )
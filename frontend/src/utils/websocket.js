@@ -1,5 +1,50 @@
 const WS_URL = import.meta.env.VITE_WS_URL || 'ws://localhost:8000';
 
+// Binary threat update frames (backend WS_BINARY_THREAT_UPDATES):
+// [u8 opcode][f32 LE score][u8 flags][u8 n][n x u8 trigger id]
+const OP_THREAT_UPDATE = 1;
+const THREAT_FLAG_REQUIRES_CAPTCHA = 1;
+
+// Index = wire id; must match THREAT_TRIGGERS in backend/app/sockets/websocket_manager.py
+const THREAT_TRIGGERS = [
+    'Device mismatch detected',
+    'IP address change detected',
+    'Multiple faces detected',
+    'No face detected',
+    'Camera blocked or covered',
+    'Unusual behavioral patterns',
+    'Facial CAPTCHA verification failed',
+    'ML model detected anomaly',
+    'Live face does not match database',
+    'Bot-like mouse behavior detected',
+];
+
+function triggerLabels(ids) {
+    return ids.map((id) => THREAT_TRIGGERS[id] || 'Unknown threat trigger');
+}
+
+function decodeBinaryFrame(buffer) {
+    const view = new DataView(buffer);
+    const opcode = view.getUint8(0);
+
+    if (opcode === OP_THREAT_UPDATE) {
+        const score = Math.round(view.getFloat32(1, true) * 100) / 100;
+        const flags = view.getUint8(5);
+        const count = view.getUint8(6);
+        const triggers = triggerLabels(Array.from(new Uint8Array(buffer, 7, count)));
+        return {
+            type: 'threat_update',
+            data: {
+                score,
+                triggers,
+                requires_facial_captcha: (flags & THREAT_FLAG_REQUIRES_CAPTCHA) !== 0,
+            },
+        };
+    }
+
+    return null;
+}
+
 class WebSocketManager {
     constructor() {
         this.socket = null;
@@ -31,6 +76,7 @@ class WebSocketManager {
 
         try {
             this.socket = new WebSocket(fullUrl);
+            this.socket.binaryType = 'arraybuffer';
 
             this.socket.onopen = () => {
                 console.log('WebSocket connected');
@@ -62,25 +108,29 @@ class WebSocketManager {
             };
 
             this.socket.onmessage = (event) => {
-                try {
-                    const data = JSON.parse(event.data);
-                    // Native websockets receive a single 'message' event.
-                    // We expect our backend to send JSON with a 'type' or 'event' field
-                    // to multiplex logical events, OR we just support specific data schemas.
-
-                    // Assuming backend sends { type: 'event_name', data: { ... } }
-                    // If not, we emit a generic 'message' event
-                    if (data.type) {
-                        this.emit(data.type, data.data || data);
+                if (event.data instanceof ArrayBuffer) {
+                    const decoded = decodeBinaryFrame(event.data);
+                    if (decoded) {
+                        this.dispatch(decoded);
                     } else {
-                        this.emit('message', data);
+                        console.error('Unknown binary WebSocket frame');
                     }
+                    return;
+                }
 
-                    // Also emit universal event for debugging
-                    this.emit('any', data);
-
+                let parsed;
+                try {
+                    parsed = JSON.parse(event.data);
                 } catch (e) {
                     console.error('Failed to parse WebSocket message:', event.data);
+                    return;
+                }
+
+                // Backend merges queued messages into a single array frame
+                if (Array.isArray(parsed)) {
+                    parsed.forEach((data) => this.dispatch(data));
+                } else {
+                    this.dispatch(parsed);
                 }
             };
 
@@ -89,6 +139,28 @@ class WebSocketManager {
         }
     }
 
+    dispatch(data) {
+        // JSON threat updates carry trigger ids; pages read the labels
+        if (data.type === 'threat_update' && data.data && Array.isArray(data.data.trigger_ids)) {
+            data.data.triggers = triggerLabels(data.data.trigger_ids);
+        }
+
+        // Native websockets receive a single 'message' event.
+        // We expect our backend to send JSON with a 'type' or 'event' field
+        // to multiplex logical events, OR we just support specific data schemas.
+
+        // Assuming backend sends { type: 'event_name', data: { ... } }
+        // If not, we emit a generic 'message' event
+        if (data.type) {
+            this.emit(data.type, data.data || data);
+        } else {
+            this.emit('message', data);
+        }
+
+        // Also emit universal event for debugging
+        this.emit('any', data);
+    }
+
     disconnect() {
         if (this.reconnectInterval) {
             clearInterval(this.reconnectInterval);